@@ -0,0 +1,215 @@
+"""
+A stand-in for JupyterHub and its users' servers, for benchmarking
+
+Implements just enough of JupyterHub's REST API, and of the terminals API
+and terminado websocket of users' servers, for jupyterhub-ssh to log users
+in and give them a shell. Every user shares the same token.
+
+The fake shell prints a '$ ' prompt and echoes input back like a terminal
+does. Entering 'bulk <bytes>' makes it print that many bytes of output,
+rounded up to a whole number of 4 KiB lines, followed by a line saying
+'DONE'. Bulk output is sent at most output_rate bytes per second.
+
+Run it on its own with:
+
+    python benchmarks/fakehub.py --port 8000 --spawn-delay 2
+"""
+import argparse
+import asyncio
+import itertools
+import json
+
+from aiohttp import web
+
+PROMPT = "$ "
+BULK_DONE = "DONE\r\n"
+# Size of the stdout messages bulk output is sent in
+BULK_CHUNK_SIZE = 4096
+
+
+class FakeHub:
+    def __init__(self, token="benchmark", spawn_delay=0, output_rate=0):
+        self.token = token
+        # Seconds it takes a user's server to start. Servers start right
+        # away if this is 0.
+        self.spawn_delay = spawn_delay
+        # Bytes per second bulk output is sent at. Unlimited if this is 0.
+        self.output_rate = output_rate
+
+        # Whether servers are ready, by user name
+        self.servers = {}
+        self.terminals = set()
+        self._terminal_names = itertools.count()
+        self._runner = None
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get("/hub/api/users", self.list_users)
+        app.router.add_get("/hub/api/users/{name}", self.get_user)
+        app.router.add_post("/hub/api/users/{name}/server", self.start_server)
+        app.router.add_get(
+            "/hub/api/users/{name}/server/progress", self.server_progress
+        )
+        app.router.add_get("/user/{name}/api/terminals", self.list_terminals)
+        app.router.add_post("/user/{name}/api/terminals", self.create_terminal)
+        app.router.add_delete(
+            "/user/{name}/api/terminals/{terminal}", self.delete_terminal
+        )
+        app.router.add_get(
+            "/user/{name}/terminals/websocket/{terminal}", self.terminal_websocket
+        )
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        Start serving, returning the URL we are served at
+        """
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = site._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def check_token(self, request):
+        if request.headers.get("Authorization") != f"token {self.token}":
+            raise web.HTTPForbidden()
+
+    def user_model(self, name):
+        servers = {}
+        if name in self.servers:
+            servers[""] = {"ready": self.servers[name], "url": f"/user/{name}/"}
+        return {"name": name, "servers": servers}
+
+    async def list_users(self, request):
+        self.check_token(request)
+        return web.json_response([self.user_model(name) for name in self.servers])
+
+    async def get_user(self, request):
+        self.check_token(request)
+        return web.json_response(self.user_model(request.match_info["name"]))
+
+    async def start_server(self, request):
+        self.check_token(request)
+        name = request.match_info["name"]
+        if name in self.servers:
+            return web.json_response({"message": "already running"}, status=400)
+        if not self.spawn_delay:
+            self.servers[name] = True
+            return web.Response(status=201)
+
+        self.servers[name] = False
+        loop = asyncio.get_running_loop()
+        loop.call_later(self.spawn_delay, self.servers.__setitem__, name, True)
+        return web.Response(status=202)
+
+    async def server_progress(self, request):
+        self.check_token(request)
+        name = request.match_info["name"]
+        if name not in self.servers:
+            raise web.HTTPBadRequest()
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        progress = 0
+        while not self.servers[name]:
+            progress = min(progress + 10, 90)
+            event = {"progress": progress, "message": "Spawning server..."}
+            await resp.write(f"data: {json.dumps(event)}\n\n".encode())
+            await asyncio.sleep(0.5)
+        event = {
+            "progress": 100,
+            "ready": True,
+            "message": "Server ready",
+            "url": f"/user/{name}/",
+        }
+        await resp.write(f"data: {json.dumps(event)}\n\n".encode())
+        return resp
+
+    async def list_terminals(self, request):
+        self.check_token(request)
+        return web.json_response([{"name": name} for name in self.terminals])
+
+    async def create_terminal(self, request):
+        self.check_token(request)
+        name = str(next(self._terminal_names))
+        self.terminals.add(name)
+        return web.json_response({"name": name})
+
+    async def delete_terminal(self, request):
+        self.check_token(request)
+        name = request.match_info["terminal"]
+        if name not in self.terminals:
+            raise web.HTTPNotFound()
+        self.terminals.discard(name)
+        return web.Response(status=204)
+
+    async def terminal_websocket(self, request):
+        self.check_token(request)
+        if request.match_info["terminal"] not in self.terminals:
+            raise web.HTTPNotFound()
+
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json.dumps(["setup", {}]))
+        await ws.send_str(json.dumps(["stdout", PROMPT]))
+        line = ""
+        async for msg in ws:
+            kind, *args = json.loads(msg.data)
+            if kind != "stdin":
+                continue
+            data = args[0]
+            # Echo input back, like a terminal would
+            await ws.send_str(json.dumps(["stdout", data.replace("\r", "\r\n")]))
+            line += data
+            while "\r" in line:
+                command, line = line.split("\r", 1)
+                await self.run_command(ws, command)
+        return ws
+
+    async def run_command(self, ws, command):
+        if command.startswith("bulk "):
+            await self.send_bulk(ws, int(command.split()[1]))
+        await ws.send_str(json.dumps(["stdout", PROMPT]))
+
+    async def send_bulk(self, ws, size):
+        chunk = json.dumps(["stdout", "x" * (BULK_CHUNK_SIZE - 2) + "\r\n"])
+        for _ in range(-(-size // BULK_CHUNK_SIZE)):
+            await ws.send_str(chunk)
+            if self.output_rate:
+                await asyncio.sleep(BULK_CHUNK_SIZE / self.output_rate)
+        await ws.send_str(json.dumps(["stdout", BULK_DONE]))
+
+
+async def serve(args):
+    hub = FakeHub(args.token, args.spawn_delay, args.output_rate)
+    url = await hub.start(args.host, args.port)
+    print(f"Fake hub running at {url}", flush=True)
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--token", default="benchmark")
+    parser.add_argument(
+        "--spawn-delay",
+        type=float,
+        default=0,
+        help="Seconds it takes users' servers to start",
+    )
+    parser.add_argument(
+        "--output-rate",
+        type=float,
+        default=0,
+        help="Bytes per second of bulk output, unlimited if 0",
+    )
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
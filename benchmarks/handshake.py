@@ -0,0 +1,171 @@
+"""
+SSH handshake benchmark of jupyterhub-ssh, by type of host key
+
+Starts the fake hub from fakehub.py and a real jupyterhub-ssh with RSA,
+Ed25519 and ECDSA host keys in their own processes, then for each host key
+algorithm, has clients preferring it connect & log in over and over,
+reporting logins per second and handshake latency.
+
+Clients run in processes of their own, so they don't limit how fast the
+server is measured to be. Logins after the first are served from
+jupyterhub-ssh's auth cache, so this mostly measures key exchange & the
+host key's signature.
+
+With jupyterhub-ssh installed, run it with:
+
+    python benchmarks/handshake.py --clients 4 --concurrency 8
+
+Arguments it doesn't know are passed on to jupyterhub-ssh, so e.g.
+--JupyterHubSSH.kex_algs=curve25519-sha256 can be benchmarked too.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import asyncssh
+from load import free_port
+from load import percentile
+from load import TOKEN
+from load import wait_for_port
+
+HOST_KEYS = {
+    "ssh-rsa": {"key_size": 4096},
+    "ssh-ed25519": {},
+    "ecdsa-sha2-nistp256": {},
+}
+HOST_KEY_ALGS = ["rsa-sha2-256", "rsa-sha2-512", "ssh-ed25519", "ecdsa-sha2-nistp256"]
+
+
+async def login_repeatedly(port, alg, deadline):
+    """
+    Log in over and over until deadline, returning how long each took
+    """
+    durations = []
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        async with asyncssh.connect(
+            "127.0.0.1",
+            port,
+            username="user-0",
+            password=TOKEN,
+            known_hosts=None,
+            server_host_key_algs=[alg],
+        ):
+            pass
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def run_client(port, alg, concurrency, duration):
+    async def run():
+        deadline = time.monotonic() + duration
+        results = await asyncio.gather(
+            *(login_repeatedly(port, alg, deadline) for _ in range(concurrency))
+        )
+        return [d for durations in results for d in durations]
+
+    return asyncio.run(run())
+
+
+def benchmark(pool, args, port, alg):
+    start = time.perf_counter()
+    results = pool.starmap(
+        run_client,
+        [(port, alg, args.concurrency, args.duration)] * args.clients,
+    )
+    elapsed = time.perf_counter() - start
+    durations = [d for client_durations in results for d in client_durations]
+    print(
+        f"{alg:>20} {len(durations) / elapsed:>10.1f} "
+        f"{percentile(durations, 50) * 1000:>9.1f} "
+        f"{percentile(durations, 99) * 1000:>9.1f}",
+        flush=True,
+    )
+
+
+async def wait_for_ports(*ports):
+    for port in ports:
+        await wait_for_port(port)
+
+
+def run(args, jupyterhub_ssh_args):
+    hub_port = free_port()
+    ssh_port = free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        host_key_args = []
+        for key_type, key_args in HOST_KEYS.items():
+            path = os.path.join(tmpdir, key_type)
+            key = asyncssh.generate_private_key(key_type, **key_args)
+            key.write_private_key(path)
+            host_key_args.append(f"--JupyterHubSSH.host_key_paths={path}")
+        hub = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(here, "fakehub.py"),
+                f"--port={hub_port}",
+                f"--token={TOKEN}",
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        # Run from an empty directory, so no config file is picked up
+        ssh = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "jupyterhub_ssh",
+                f"--JupyterHubSSH.hub_url=http://127.0.0.1:{hub_port}",
+                f"--JupyterHubSSH.port={ssh_port}",
+                *host_key_args,
+                "--JupyterHubSSH.debug=False",
+                *jupyterhub_ssh_args,
+            ],
+            cwd=tmpdir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            asyncio.run(wait_for_ports(hub_port, ssh_port))
+            print(f"{'host key alg':>20} {'logins/s':>10} {'p50':>9} {'p99 (ms)':>9}")
+            with multiprocessing.Pool(args.clients) as pool:
+                # Warm up jupyterhub-ssh's caches
+                pool.starmap(run_client, [(ssh_port, "ssh-ed25519", 1, 0.5)])
+                for alg in HOST_KEY_ALGS:
+                    benchmark(pool, args, ssh_port, alg)
+        finally:
+            for process in (ssh, hub):
+                process.terminate()
+                process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        epilog="Other arguments are passed on to jupyterhub-ssh",
+    )
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=os.cpu_count(),
+        help="Client processes to log in from",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Concurrent logins per client"
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=10,
+        help="Seconds to benchmark each host key algorithm for",
+    )
+    args, jupyterhub_ssh_args = parser.parse_known_args()
+    run(args, jupyterhub_ssh_args)
+
+
+if __name__ == "__main__":
+    main()
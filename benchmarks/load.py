@@ -0,0 +1,246 @@
+"""
+Load & latency benchmark of jupyterhub-ssh against a fake JupyterHub
+
+Starts the fake hub from fakehub.py and a real jupyterhub-ssh in their own
+processes, then for increasing numbers of concurrent SSH sessions reports:
+
+- logins per second, each login being a new SSH connection & authentication
+- time from connecting to seeing the first shell prompt
+- keystroke echo latency, the time from sending a key to seeing it echoed
+- bulk output throughput, summed over all sessions
+
+With jupyterhub-ssh installed, run it with:
+
+    python benchmarks/load.py --sessions 64
+
+Arguments it doesn't know are passed on to jupyterhub-ssh, so e.g.
+--JupyterHubSSH.terminal_pool_size=1 or --workers=4 can be benchmarked too.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import AsyncExitStack
+
+import asyncssh
+from fakehub import BULK_DONE
+from fakehub import PROMPT
+
+TOKEN = "benchmark"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+
+def connect(port, username):
+    return asyncssh.connect(
+        "127.0.0.1",
+        port,
+        username=username,
+        password=TOKEN,
+        known_hosts=None,
+    )
+
+
+async def login(port, username, count):
+    for _ in range(count):
+        async with connect(port, username):
+            pass
+
+
+async def open_session(stack, port, username):
+    """
+    Open an interactive session, returning it & the time to its first prompt
+    """
+    start = time.perf_counter()
+    conn = await stack.enter_async_context(connect(port, username))
+    process = await conn.create_process(term_type="xterm")
+    await process.stdout.readuntil(PROMPT)
+    return process, time.perf_counter() - start
+
+
+async def type_keys(process, keystrokes):
+    """
+    Type a key at a time, returning how long each took to be echoed
+    """
+    echoes = []
+    for _ in range(keystrokes):
+        start = time.perf_counter()
+        process.stdin.write("a")
+        await process.stdout.readexactly(1)
+        echoes.append(time.perf_counter() - start)
+    process.stdin.write("\r")
+    await process.stdout.readuntil(PROMPT)
+    return echoes
+
+
+async def read_bulk(process, size):
+    process.stdin.write(f"bulk {size}\r")
+    # Bulk output ends with a line saying it is done, then the next prompt
+    end = BULK_DONE + PROMPT
+    tail = ""
+    while not tail.endswith(end):
+        tail = (tail + await process.stdout.read(65536))[-len(end) :]
+
+
+async def run_level(args, port, sessions):
+    users = [f"user-{i}" for i in range(sessions)]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(login(port, user, args.logins) for user in users))
+    logins_per_second = sessions * args.logins / (time.perf_counter() - start)
+
+    async with AsyncExitStack() as stack:
+        opened = await asyncio.gather(
+            *(open_session(stack, port, user) for user in users)
+        )
+        processes = [process for process, _ in opened]
+        first_prompts = [first_prompt for _, first_prompt in opened]
+
+        typed = await asyncio.gather(
+            *(type_keys(process, args.keystrokes) for process in processes)
+        )
+        echoes = [echo for session_echoes in typed for echo in session_echoes]
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(read_bulk(process, args.bulk_bytes) for process in processes)
+        )
+        throughput = sessions * args.bulk_bytes / (time.perf_counter() - start)
+
+    print(
+        f"{sessions:>8} {logins_per_second:>10.1f} "
+        f"{percentile(first_prompts, 50) * 1000:>9.1f} "
+        f"{percentile(first_prompts, 99) * 1000:>9.1f} "
+        f"{percentile(echoes, 50) * 1000:>9.2f} "
+        f"{percentile(echoes, 99) * 1000:>9.2f} "
+        f"{throughput / 1024 / 1024:>10.1f}",
+        flush=True,
+    )
+
+
+def session_levels(max_sessions):
+    sessions = 1
+    while sessions < max_sessions:
+        yield sessions
+        sessions *= 2
+    yield max_sessions
+
+
+async def run(args, jupyterhub_ssh_args):
+    hub_port = free_port()
+    ssh_port = free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        host_key_path = os.path.join(tmpdir, "host_key")
+        asyncssh.generate_private_key("ssh-ed25519").write_private_key(host_key_path)
+        hub = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(here, "fakehub.py"),
+                f"--port={hub_port}",
+                f"--token={TOKEN}",
+                f"--spawn-delay={args.spawn_delay}",
+                f"--output-rate={args.output_rate}",
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        # Run from an empty directory, so no config file is picked up
+        ssh = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "jupyterhub_ssh",
+                f"--JupyterHubSSH.hub_url=http://127.0.0.1:{hub_port}",
+                f"--JupyterHubSSH.port={ssh_port}",
+                f"--JupyterHubSSH.host_key_path={host_key_path}",
+                "--JupyterHubSSH.debug=False",
+                *jupyterhub_ssh_args,
+            ],
+            cwd=tmpdir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            await wait_for_port(hub_port)
+            await wait_for_port(ssh_port)
+            print(
+                f"{'sessions':>8} {'logins/s':>10} "
+                f"{'prompt p50':>9} {'p99 (ms)':>9} "
+                f"{'echo p50':>9} {'p99 (ms)':>9} {'bulk MiB/s':>10}"
+            )
+            for sessions in session_levels(args.sessions):
+                await run_level(args, ssh_port, sessions)
+        finally:
+            for process in (ssh, hub):
+                process.terminate()
+                process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        epilog="Other arguments are passed on to jupyterhub-ssh",
+    )
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=16,
+        help="Most concurrent sessions to benchmark, doubling from 1",
+    )
+    parser.add_argument(
+        "--logins", type=int, default=10, help="Logins per session, in a row"
+    )
+    parser.add_argument(
+        "--keystrokes", type=int, default=100, help="Keystrokes per session"
+    )
+    parser.add_argument(
+        "--bulk-bytes",
+        type=int,
+        default=4 * 1024 * 1024,
+        help="Bytes of bulk output per session",
+    )
+    parser.add_argument(
+        "--spawn-delay",
+        type=float,
+        default=0,
+        help="Seconds it takes users' servers to start",
+    )
+    parser.add_argument(
+        "--output-rate",
+        type=float,
+        default=0,
+        help="Bytes per second of bulk output per session, unlimited if 0",
+    )
+    args, jupyterhub_ssh_args = parser.parse_known_args()
+    asyncio.run(run(args, jupyterhub_ssh_args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+Memory soak benchmark of jupyterhub-ssh with many idle sessions
+
+Starts the fake hub from fakehub.py and a real jupyterhub-ssh in their own
+processes, then opens increasing numbers of interactive SSH sessions that
+sit idle at their shell prompt, reporting jupyterhub-ssh's resident memory
+and how much of it each idle session takes up.
+
+Sessions are opened from client processes of their own, and stay open
+while more are added for the next level. Memory is read from /proc, so this
+only runs on Linux. Each session takes up two file descriptors in
+jupyterhub-ssh, so the open file limit is raised as far as allowed.
+
+With jupyterhub-ssh installed, run it with:
+
+    python benchmarks/soak.py --levels 1000,5000,10000
+
+Arguments it doesn't know are passed on to jupyterhub-ssh, so e.g.
+--JupyterHubSSH.ssh_window=262144 can be benchmarked too.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import asyncssh
+from fakehub import PROMPT
+from load import connect
+from load import free_port
+from load import TOKEN
+from load import wait_for_port
+
+
+def rss_bytes(pid):
+    """
+    Return resident memory of a process and all its descendants
+    """
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+                break
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            for child in f.read().split():
+                rss += rss_bytes(int(child))
+    return rss
+
+
+def raise_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        # Inherited by the processes we start
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+async def open_session(port, username, semaphore, connections):
+    async with semaphore:
+        conn = await connect(port, username)
+        connections.append(conn)
+        process = await conn.create_process(term_type="xterm")
+        await process.stdout.readuntil(PROMPT)
+
+
+def run_client(port, users, first, step, pipe):
+    """
+    Open as many sessions as asked for through pipe, until asked for None
+
+    The client's sessions are the first, first + step, first + 2 * step...
+    of all clients' sessions, which are spread over users round robin.
+    """
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(32)
+        connections = []
+        opened = 0
+        while True:
+            target = await loop.run_in_executor(None, pipe.recv)
+            if target is None:
+                break
+            await asyncio.gather(
+                *(
+                    open_session(
+                        port,
+                        users[(first + i * step) % len(users)],
+                        semaphore,
+                        connections,
+                    )
+                    for i in range(opened, target)
+                )
+            )
+            opened = target
+            pipe.send(opened)
+        for conn in connections:
+            conn.close()
+        await asyncio.gather(*(conn.wait_closed() for conn in connections))
+
+    asyncio.run(run())
+
+
+def open_sessions(clients, sessions):
+    """
+    Have clients open sessions between them, and wait until they have
+    """
+    for i, (process, pipe) in enumerate(clients):
+        pipe.send(sessions // len(clients) + (i < sessions % len(clients)))
+    for process, pipe in clients:
+        pipe.recv()
+
+
+def run(args, jupyterhub_ssh_args):
+    hub_port = free_port()
+    ssh_port = free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    open_files = raise_open_files_limit()
+    if max(args.levels) * 2 > open_files:
+        print(
+            f"Open file limit of {open_files} may be too low for "
+            f"{max(args.levels)} sessions",
+            file=sys.stderr,
+        )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        host_key_path = os.path.join(tmpdir, "host_key")
+        asyncssh.generate_private_key("ssh-ed25519").write_private_key(host_key_path)
+        hub = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(here, "fakehub.py"),
+                f"--port={hub_port}",
+                f"--token={TOKEN}",
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        # Run from an empty directory, so no config file is picked up
+        ssh = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "jupyterhub_ssh",
+                f"--JupyterHubSSH.hub_url=http://127.0.0.1:{hub_port}",
+                f"--JupyterHubSSH.port={ssh_port}",
+                f"--JupyterHubSSH.host_key_paths={host_key_path}",
+                "--JupyterHubSSH.debug=False",
+                *jupyterhub_ssh_args,
+            ],
+            cwd=tmpdir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        users = [f"user-{i}" for i in range(args.users)]
+        clients = []
+        try:
+            asyncio.run(wait_for_port(hub_port))
+            asyncio.run(wait_for_port(ssh_port))
+            for i in range(args.clients):
+                pipe, client_pipe = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=run_client,
+                    args=(ssh_port, users, i, args.clients, client_pipe),
+                )
+                process.start()
+                clients.append((process, pipe))
+
+            # Open a session per user first, so what users cost on their
+            # own (auth cache entries...) isn't counted against sessions
+            baseline_sessions = len(users)
+            open_sessions(clients, baseline_sessions)
+            time.sleep(args.settle)
+            baseline = rss_bytes(ssh.pid)
+            print(f"Baseline RSS {baseline / 1024 / 1024:.1f} MiB", flush=True)
+            print(f"{'sessions':>8} {'RSS (MiB)':>10} {'per session (KiB)':>18}")
+            for sessions in args.levels:
+                start = time.perf_counter()
+                open_sessions(clients, sessions)
+                opened = time.perf_counter() - start
+                time.sleep(args.settle)
+                rss = rss_bytes(ssh.pid)
+                per_session = (rss - baseline) / (sessions - baseline_sessions)
+                print(
+                    f"{sessions:>8} {rss / 1024 / 1024:>10.1f} "
+                    f"{per_session / 1024:>18.1f}"
+                    f"   (opened in {opened:.1f}s)",
+                    flush=True,
+                )
+        finally:
+            for process, pipe in clients:
+                pipe.send(None)
+            for process, pipe in clients:
+                process.join()
+            for process in (ssh, hub):
+                process.terminate()
+                process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        epilog="Other arguments are passed on to jupyterhub-ssh",
+    )
+    parser.add_argument(
+        "--levels",
+        type=lambda levels: sorted(int(level) for level in levels.split(",")),
+        default=[1000, 5000, 10000],
+        help="Comma separated numbers of idle sessions to measure memory at",
+    )
+    parser.add_argument(
+        "--users", type=int, default=100, help="Users sessions are spread over"
+    )
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=os.cpu_count(),
+        help="Client processes to open sessions from",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=5,
+        help="Seconds to wait after opening sessions before measuring memory",
+    )
+    args, jupyterhub_ssh_args = parser.parse_known_args()
+    if args.levels[0] <= args.users:
+        parser.error("--levels must all be more than --users")
+    run(args, jupyterhub_ssh_args)
+
+
+if __name__ == "__main__":
+    main()
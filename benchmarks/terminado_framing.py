@@ -0,0 +1,60 @@
+"""
+Microbenchmark of encoding & decoding terminado websocket messages
+
+Compares the plain JSON (de)serialization of whole messages we used to do with
+the framing helpers in jupyterhub_ssh.terminado, reporting messages per
+second for each. With jupyterhub-ssh installed, run it with:
+
+    python benchmarks/terminado_framing.py
+"""
+import json
+import timeit
+
+from jupyterhub_ssh import terminado
+
+KEYSTROKE = "l"
+PASTE = "for i in range(10):\r    print(i)\r" * 8
+OUTPUT_LINE = json.dumps(
+    ["stdout", "drwxr-xr-x  2 jovyan users 4096 Jan  1 00:00 ü\r\n"]
+)
+OUTPUT_BLOCK = json.dumps(["stdout", "x" * 4000 + "\r\n"])
+
+
+def rate(stmt, number):
+    seconds = min(timeit.repeat(stmt, number=number, repeat=5))
+    return number / seconds
+
+
+def compare(name, before, after, number=200000):
+    before_rate = rate(before, number)
+    after_rate = rate(after, number)
+    print(
+        f"{name:<24} {before_rate:>14,.0f} {after_rate:>14,.0f} "
+        f"{after_rate / before_rate:>8.2f}x"
+    )
+
+
+def main():
+    print(f"JSON backend: {'orjson' if terminado.orjson else 'json'}")
+    print(f"{'frames/sec':<24} {'before':>14} {'after':>14} {'speedup':>9}")
+    for name, data in [("stdin keystroke", KEYSTROKE), ("stdin paste", PASTE)]:
+        compare(
+            name,
+            lambda: json.dumps(["stdin", data]),
+            lambda: terminado.encode_stdin(data),
+        )
+    compare(
+        "set_size",
+        lambda: json.dumps(["set_size", 24, 80]),
+        lambda: terminado.encode_set_size(24, 80),
+    )
+    for name, message in [("stdout line", OUTPUT_LINE), ("stdout block", OUTPUT_BLOCK)]:
+        compare(
+            name,
+            lambda: json.loads(message),
+            lambda: terminado.decode_message(message),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -101,3 +101,21 @@ previously set hostKey, or generate and return a new hostKey.
         {{- end }}
     {{- end }}
 {{- end }}
+
+{{- /*
+Like jupyterhub-ssh.hostKey, but for the Ed25519 host key only used by
+jupyterhub-ssh, which makes logins much quicker for the many SSH clients
+preferring Ed25519 host keys over RSA ones.
+*/}}
+{{- define "jupyterhub-ssh.hostKeyEd25519" -}}
+    {{- if .Values.hostKeyEd25519 }}
+        {{- .Values.hostKeyEd25519 }}
+    {{- else }}
+        {{- $k8s_state := lookup "v1" "Secret" .Release.Namespace (include "jupyterhub-ssh.fullname" .) | default (dict "data" (dict)) }}
+        {{- if hasKey $k8s_state.data "hostKeyEd25519" }}
+            {{- index $k8s_state.data "hostKeyEd25519" | b64dec }}
+        {{- else }}
+            {{- genPrivateKey "ed25519" }}
+        {{- end }}
+    {{- end }}
+{{- end }}
@@ -0,0 +1,530 @@
+#!/usr/bin/python3
+"""
+Verify that JupyterHub tokens are valid for given users, for sshd's PAM
+
+pam_exec starts jupyterhub-token-verify.py for every login, and a Python
+interpreter importing requests, reading our config & connecting to the hub
+anew for each login takes long enough to matter when many users log in at
+once. So this long running daemon does the actual work instead, and
+jupyterhub-token-verify.py just asks it over a Unix socket only root can
+connect to.
+
+Connections to the hub are kept alive and reused, and users who logged in
+with the same token in the last CACHE_TTL seconds are let in without
+asking the hub again.
+
+# SECURITY WARNING!!!!
+
+This code runs as **ROOT**, and deals with **User Input**
+(in the form of username), manipulating paths on the host filesystem.
+This requires a very high standard for securing it, since security
+lapses here will lead to exposing users' home directories. At
+the very least, watch out for the following classes of vulnerabilities:
+
+1. Path Traversal Attacks - https://owasp.org/www-community/attacks/Path_Traversal
+2. Arbitrary code execution vulnerabilities in YAML
+3. Sending hub tokens to arbitrary URLs, not just the configured hub
+
+There's gonna be more, but really - just watch out!
+
+# bind mounting and chroot
+
+sshd supports chrooting to a given directory after authenticating as
+a user. This is required for SFTP so we can expose *just* a user's
+home directory to them, without accidentally also exposing other
+users' home directories. sshd requires that all the directories in the
+path - including the user's home directory - are owned by root and
+not writeably by anyone else. This is a little problematic for our
+use case - JupyterHub home directories are usually writeable by
+the user. So we can't directly chroot to the directories. We also
+can't just chroot to the parent directory - it contains all the
+users' home directories, and they're all usually owned by the same uid
+(1000).
+
+So in *this* script, we do some bind mounting magic to make this work.
+We provision a directory (${DEST_DIR}) owned by root. For each user
+who successfully logs in, we:
+
+1. Create an empty, root owned directory (${DEST_DIR}/${USERNAME})
+2. Create another empty, root owned directory inside this -
+   (${DEST_DIR}/${USERNAME}/${USERNAME}). This will act as a
+   bind target only.
+3. Bind mount the user's actual home directory (${SRC_DIR}/${USERNAME})
+   to this nested directory (${DEST_DIR}/${USERNAME}/${USERNAME}).
+4. Make sshd chroot to the first level directory (${DEST_DIR}/${USERNAME}).
+   This is root owned, so it's fine.
+5. Tell sftp to start in the subdirectory where our user's home directory
+   has been bind mounted (${DEST_DIR}/${USERNAME}/${USERNAME}). This shows
+   them their home directory when they log in, but at most they can
+   escape to the parent directory - nowhere else, thanks to the proper
+   chrooting.
+
+We do this if needed when a user logs in. However, the user
+controls ${USERNAME}. If we aren't careful, they can use it to have us
+give them read (and possibly write) access to *any* part of the filesystem.
+So we have to be very careful doing this.
+
+Mounts are not kept forever, as a mount table with thousands of entries
+slows down every mount, umount and chroot. Users who haven't logged in for
+MOUNT_IDLE_TTL seconds are unmounted and their directories removed, and
+at most MAX_MOUNTS users stay mounted, the least recently used being
+unmounted first. Users with an SFTP session still chrooted to their
+directory are never unmounted. Mounts left by a previous run of this
+daemon are found in /proc/self/mountinfo when it starts, and are unmounted
+over the following MOUNT_IDLE_TTL seconds unless used.
+
+# DEVELOPER NOTES
+
+Logs are written to stderr, which start.bash shares with sshd's. Tokens
+must never be logged.
+
+Requests are a username and password (token) separated by a null byte,
+which the client ends by shutting down its side of the connection. The
+response is "ok" if the user may log in, anything else (including no
+response at all) means they may not.
+"""
+import hashlib
+import logging
+import os
+import re
+import socket
+import socketserver
+import stat
+import string
+import struct
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from pathlib import PosixPath
+
+import requests
+from escapism import escape
+
+SOCKET_PATH = PosixPath("/run/jupyterhub-token-verify/socket")
+HUB_URL_PATH = "/etc/jupyterhub-sftp/config/hubUrl"
+
+# Seconds to remember a user successfully logged in with a token for
+CACHE_TTL = 60
+CACHE_MAX_SIZE = 10000
+# Seconds to wait for the hub to respond
+HUB_TIMEOUT = 10
+# Most concurrent requests to the hub, and connections kept to it
+HUB_POOL_SIZE = 16
+MAX_REQUEST_SIZE = 65536
+
+# Seconds after their last login to unmount users' home directories
+MOUNT_IDLE_TTL = float(os.environ.get("JUPYTERHUB_SFTP_MOUNT_IDLE_TTL", 24 * 3600))
+# Most users to keep mounted at once
+MAX_MOUNTS = int(os.environ.get("JUPYTERHUB_SFTP_MAX_MOUNTS", 1000))
+# Seconds between looking for idle mounts, done as users log in
+MOUNT_SWEEP_INTERVAL = 60
+# Most users to unmount per look, so a sweep never runs long
+MAX_UNMOUNTS_PER_SWEEP = 100
+
+log = logging.getLogger("jupyterhub-token-verifyd")
+
+
+class TokenCache:
+    """
+    Remember which (username, token) pairs were valid, for ttl seconds
+
+    Only hashes of tokens are kept in memory. At most max_size pairs are
+    remembered, the least recently used being forgotten first.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expiry = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, username, token):
+        return (username, hashlib.sha256(token.encode("utf-8")).digest())
+
+    def __contains__(self, key):
+        with self._lock:
+            expiry = self._expiry.get(key)
+            if expiry is None:
+                return False
+            if expiry < time.monotonic():
+                del self._expiry[key]
+                return False
+            self._expiry.move_to_end(key)
+            return True
+
+    def add(self, key):
+        with self._lock:
+            self._expiry[key] = time.monotonic() + self.ttl
+            self._expiry.move_to_end(key)
+            while len(self._expiry) > self.max_size:
+                self._expiry.popitem(last=False)
+
+
+def make_hub_session():
+    """
+    Return a requests session keeping connections to the hub alive
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=HUB_POOL_SIZE, pool_block=True
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def valid_user(session, hub_url, username, token):
+    """
+    Check if token is valid for username in hub at hub_url
+    """
+    # FIXME: Construct this URL better?
+    url = f"{hub_url}/hub/api/user"
+    headers = {"Authorization": f"token {token}"}
+    resp = session.get(url, headers=headers, timeout=HUB_TIMEOUT)
+    return resp.status_code == 200
+
+
+# Directory containing user home directories
+SRC_DIR = PosixPath("/mnt/home")
+# Directory sshd is exposing. We will bind-mount users there
+DEST_DIR = PosixPath("/export/home")
+
+
+def user_paths(untrusted_username):
+    """
+    Return home, chroot & bind mount paths of a user, checked to be safe
+    """
+    # username is user controlled data, so should be treated more cautiously
+    # It's been authenticated as valid by sshd, but that doesn't mean anything
+    # However, the untrusted username is what sshd will use as chroot, so we
+    # have to do our bind mounts there.
+    #
+
+    # In JupyterHub, we escape most file system naming interactions with this
+    # escapism call. This should also work here to make sure we mount the correct
+    # directory.
+    # FIXME: Verify usernames starting with '-' work fine with PAM & NSS
+    safe_chars = set(string.ascii_lowercase + string.digits)
+    source_username = escape(
+        untrusted_username, safe=safe_chars, escape_char="-"
+    ).lower()
+
+    # To protect against path traversal attacks, we:
+    # 1. Resolve our paths to absolute paths, traversing any symlinks if needed
+    # 2. Make sure that the absolote paths are within the source directories appropriately
+    # This prevents any relative path (..) or symlink attacks.
+    src_path = (SRC_DIR / source_username).resolve()
+
+    # Make sure src_path isn't outside of SRC_DIR
+    # And doesn't refer to other users' home directories
+    assert str(src_path.relative_to(SRC_DIR)) == source_username
+
+    dest_chroot_path = (DEST_DIR / untrusted_username).resolve()
+    # Make sure dest_chroot_path isn't outside of DEST_DIR
+    assert str(dest_chroot_path.relative_to(DEST_DIR)) == untrusted_username
+
+    dest_bind_path = (dest_chroot_path / untrusted_username).resolve()
+    # Make sure dest_bind_path isn't outside dest_chroot_path
+    assert str(dest_bind_path.relative_to(dest_chroot_path)) == untrusted_username
+
+    return src_path, dest_chroot_path, dest_bind_path
+
+
+def unescape_mountinfo(field):
+    """
+    Undo the octal escaping of spaces & such in /proc/self/mountinfo
+    """
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def mounted_users(mountinfo="/proc/self/mountinfo"):
+    """
+    Return the users whose home directories are bind mounted in DEST_DIR,
+    in the order they were mounted
+    """
+    users = {}
+    with open(mountinfo) as f:
+        for line in f:
+            # The mount point is the fifth field
+            mount_point = PosixPath(unescape_mountinfo(line.split(" ")[4]))
+            try:
+                parts = mount_point.relative_to(DEST_DIR).parts
+            except ValueError:
+                continue
+            if len(parts) == 2 and parts[0] == parts[1]:
+                users[parts[0]] = None
+    return list(users)
+
+
+def chrooted_users():
+    """
+    Return the users an SFTP session is chrooted to the directory of
+    """
+    users = set()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            root = PosixPath(os.readlink(f"/proc/{pid}/root"))
+        except OSError:
+            # Gone already, or not ours to look at
+            continue
+        if root.parent == DEST_DIR:
+            users.add(root.name)
+    return users
+
+
+class MountManager:
+    """
+    Bind mount users' home directories as they log in, and unmount them
+    once they are idle or too many are mounted
+
+    Users are unmounted lazily: while users log in, every sweep_interval
+    seconds those who last logged in more than idle_ttl seconds ago are
+    unmounted, as are the least recently used users beyond max_mounts.
+
+    Sweeps run in a thread of their own, and unmount at most
+    max_unmounts_per_sweep users each. Looking for chrooted SFTP sessions
+    and unmounting are done without holding the lock, so logins aren't held
+    up by them. A user being unmounted isn't mounted again until that is
+    done.
+    """
+
+    def __init__(self, idle_ttl, max_mounts, sweep_interval, max_unmounts_per_sweep):
+        self.idle_ttl = idle_ttl
+        self.max_mounts = max_mounts
+        self.sweep_interval = sweep_interval
+        self.max_unmounts_per_sweep = max_unmounts_per_sweep
+
+        self._lock = threading.Lock()
+        # Notified whenever users are done being unmounted
+        self._unmounted = threading.Condition(self._lock)
+        # Monotonic time of last login by mounted user, least recent first.
+        # When users mounted before we started last logged in is unknown, so
+        # they count as having logged in at times spread evenly over the
+        # last idle_ttl seconds, in the order they were mounted. That way they
+        # don't all become idle at once.
+        now = time.monotonic()
+        found = mounted_users()
+        self._last_used = OrderedDict(
+            (user, now - self.idle_ttl * (len(found) - i) / (len(found) + 1))
+            for i, user in enumerate(found)
+        )
+        # Users being unmounted right now
+        self._unmounting = set()
+        self._sweeping = False
+        self._next_sweep = now + sweep_interval
+        log.info("Found %i mounted users", len(self._last_used))
+
+    def mount(self, untrusted_username):
+        """
+        Make sure untrusted_username's home directory is mounted
+        """
+        src_path, dest_chroot_path, dest_bind_path = user_paths(untrusted_username)
+
+        # Concurrent logins of the same user mustn't both mount
+        with self._lock:
+            self._unmounted.wait_for(lambda: untrusted_username not in self._unmounting)
+            if untrusted_username not in self._last_used:
+                os.makedirs(dest_chroot_path, exist_ok=True)
+                os.makedirs(dest_bind_path, exist_ok=True)
+                subprocess.check_call(["mount", "-o", "bind", src_path, dest_bind_path])
+            now = time.monotonic()
+            self._last_used[untrusted_username] = now
+            self._last_used.move_to_end(untrusted_username)
+
+            if self._sweeping:
+                return
+            if now < self._next_sweep and len(self._last_used) <= self.max_mounts:
+                return
+            self._next_sweep = now + self.sweep_interval
+            self._sweeping = True
+        threading.Thread(target=self.sweep, name="mount-sweeper", daemon=True).start()
+
+    def sweep(self):
+        """
+        Unmount idle users, and the least recently used ones beyond our max
+        """
+        try:
+            self._sweep()
+        except Exception:
+            log.exception("Failed to sweep mounts")
+        finally:
+            with self._lock:
+                self._sweeping = False
+
+    def _sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            excess = len(self._last_used) - self.max_mounts
+            candidates = {}
+            for user, last_used in self._last_used.items():
+                if len(candidates) >= self.max_unmounts_per_sweep:
+                    break
+                if last_used > now - self.idle_ttl and len(candidates) >= excess:
+                    break
+                candidates[user] = last_used
+        if not candidates:
+            return
+
+        in_use = chrooted_users()
+        for user, last_used in candidates.items():
+            with self._lock:
+                if self._last_used.get(user) != last_used:
+                    # Logged in since it was picked
+                    continue
+                if user in in_use:
+                    # Counts as used, so it isn't looked at again right away
+                    self._last_used[user] = now
+                    self._last_used.move_to_end(user)
+                    continue
+                del self._last_used[user]
+                self._unmounting.add(user)
+
+            try:
+                self.unmount(user)
+            except Exception:
+                log.exception("Failed to unmount home of user %r", user)
+                failed = True
+            else:
+                failed = False
+            with self._lock:
+                if failed:
+                    # Still mounted, so try again next sweep
+                    self._last_used[user] = last_used
+                    self._last_used.move_to_end(user, last=False)
+                self._unmounting.remove(user)
+                self._unmounted.notify_all()
+
+        with self._lock:
+            mounted = len(self._last_used)
+        if mounted > self.max_mounts:
+            log.warning(
+                "%i users are mounted, more than %i as some are in use",
+                mounted,
+                self.max_mounts,
+            )
+
+    def unmount(self, untrusted_username):
+        """
+        Unmount a user's home directory, and remove the directories it was
+        mounted at
+        """
+        _, dest_chroot_path, dest_bind_path = user_paths(untrusted_username)
+        # Lazily, so nothing that still has files open there breaks
+        subprocess.check_call(["umount", "--lazy", dest_bind_path])
+        os.rmdir(dest_bind_path)
+        os.rmdir(dest_chroot_path)
+        log.info("Unmounted home of user %r", untrusted_username)
+
+
+def peer_uid(sock):
+    """
+    Return uid of the process at the other end of a Unix socket
+    """
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+class VerifyHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # The socket is only accessible to root already, but be sure
+        if peer_uid(self.request) != 0:
+            log.warning("Refusing request from a process not running as root")
+            return
+
+        self.request.settimeout(HUB_TIMEOUT)
+        request = b""
+        while len(request) <= MAX_REQUEST_SIZE:
+            data = self.request.recv(MAX_REQUEST_SIZE)
+            if not data:
+                break
+            request += data
+        else:
+            log.warning("Refusing request larger than %i bytes", MAX_REQUEST_SIZE)
+            return
+
+        try:
+            untrusted_username, password = request.decode("utf-8").split("\x00", 1)
+        except ValueError:
+            log.warning("Refusing malformed request")
+            return
+
+        if self.server.verify(untrusted_username, password):
+            self.request.sendall(b"ok")
+        else:
+            self.request.sendall(b"no")
+
+
+class VerifyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, hub_url):
+        self.hub_url = hub_url
+        self.session = make_hub_session()
+        self.cache = TokenCache(CACHE_TTL, CACHE_MAX_SIZE)
+        self.mounts = MountManager(
+            MOUNT_IDLE_TTL, MAX_MOUNTS, MOUNT_SWEEP_INTERVAL, MAX_UNMOUNTS_PER_SWEEP
+        )
+        super().__init__(str(path), VerifyHandler)
+
+    def verify(self, untrusted_username, password):
+        """
+        Check if password is a valid token for untrusted_username, and if so
+        get their home directory ready
+        """
+        key = self.cache.key(untrusted_username, password)
+        if key not in self.cache:
+            try:
+                valid = valid_user(
+                    self.session, self.hub_url, untrusted_username, password
+                )
+            except requests.RequestException as e:
+                log.error("Failed to verify token with the hub: %r", e)
+                return False
+            if not valid:
+                log.info("Invalid token for user %r", untrusted_username)
+                return False
+            self.cache.add(key)
+
+        try:
+            # FIXME: We're doing a bind mount here based on an untrusted_username
+            # THIS IS *SCARY* and we should do more work to ensure we aren't
+            # accidentally exposing user data.
+            self.mounts.mount(untrusted_username)
+        except Exception:
+            log.exception("Failed to bind mount home of user %r", untrusted_username)
+            return False
+        return True
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s"
+    )
+
+    with open(HUB_URL_PATH, "r") as f:
+        hub_url = f.read()
+
+    # Only root may connect, both by the directory's and socket's mode
+    os.makedirs(SOCKET_PATH.parent, mode=0o700, exist_ok=True)
+    os.chmod(SOCKET_PATH.parent, 0o700)
+    if SOCKET_PATH.exists() or SOCKET_PATH.is_symlink():
+        SOCKET_PATH.unlink()
+    old_umask = os.umask(0o177)
+    try:
+        server = VerifyServer(SOCKET_PATH, hub_url)
+    finally:
+        os.umask(old_umask)
+    assert stat.S_IMODE(os.stat(SOCKET_PATH).st_mode) == 0o600
+
+    log.info("Listening on %s", SOCKET_PATH)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
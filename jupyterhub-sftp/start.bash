@@ -0,0 +1,27 @@
+#!/bin/bash
+set -euo pipefail
+
+# Runs the token verification daemon alongside sshd, which asks it to verify
+# tokens via PAM (see jupyterhub-token-verify.py). If either exits, so does
+# this script, and with it the container.
+
+/usr/sbin/jupyterhub-token-verifyd.py &
+
+# Let sshd accept logins only once the daemon can verify them
+for _ in $(seq 50); do
+    if [ -S /run/jupyterhub-token-verify/socket ]; then
+        break
+    fi
+    sleep 0.1
+done
+
+# sshd reference:
+# -D    sshd will not detach and does not become a daemon
+# -e    sshd will send the output to the standard error instead of the system
+#       log.
+/usr/sbin/sshd -De &
+
+# Forward termination to both, so terminating the container stays quick
+trap 'kill -TERM $(jobs -p) 2>/dev/null' TERM INT
+
+wait -n
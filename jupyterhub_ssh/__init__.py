@@ -1,19 +1,68 @@
 import asyncio
+import json
 import logging
+import os
+import random
+import signal
+import time
+from contextlib import asynccontextmanager
 from functools import partial
 
 import asyncssh
 from aiohttp import ClientSession
+from aiohttp import DummyCookieJar
+from aiohttp import TCPConnector
 from async_timeout import timeout
 from traitlets import Any
 from traitlets import Bool
+from traitlets import Enum
+from traitlets import Float
 from traitlets import Integer
+from traitlets import List
 from traitlets import Unicode
 from traitlets import validate
 from traitlets.config import Application
 from yarl import URL
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from .cache import auth_cache_key
+from .cache import TTLCache
+from .compression import CompressionStats
+from .compression import deflate_extension
+from .forwarding import ForwardedChannel
+from .forwarding import proxy_prefix
+from .keys import AuthorizedKeysIndex
+from .metrics import ACTIVE_CONNECTIONS
+from .metrics import ACTIVE_SESSIONS
+from .metrics import AUTH_DURATION_SECONDS
+from .metrics import clear_multiprocess_dir
+from .metrics import DETACHED_SESSIONS
+from .metrics import HUB_API_DURATION_SECONDS
+from .metrics import mark_worker_dead
+from .metrics import multiprocess_enabled
+from .metrics import SPAWN_WAIT_DURATION_SECONDS
+from .metrics import start_metrics_server
+from .metrics import WEBSOCKET_COMPRESSION_CPU_SECONDS
+from .metrics import WEBSOCKET_COMPRESSION_RATIO
+from .pool import TerminalPool
+from .relay import InputBatcher
+from .relay import OutputBatcher
+from .sessions import SESSION_ENV
+from .sessions import TerminalSession
+from .sftp import ContentsSFTPServer
+from .sweeper import TerminalSweeper
 from .terminado import Terminado
+from .tracing import JSONLinesExporter
+from .tracing import NullTracer
+from .tracing import OTLPExporter
+from .tracing import Tracer
+from .watchdog import LoopWatchdog
+from .workers import Supervisor
+from .workers import WorkerStats
 
 
 class NotebookSSHServer(asyncssh.SSHServer):
@@ -23,6 +72,9 @@ class NotebookSSHServer(asyncssh.SSHServer):
 
     def __init__(self, app, *args, **kwargs):
         self.app = app
+        self.public_key_login = False
+        # Limits requests forwarded at once over this connection's channels
+        self.forwarded_requests = asyncio.Semaphore(app.port_forwarding_max_requests)
         super().__init__(*args, **kwargs)
 
     def connection_made(self, conn):
@@ -30,17 +82,104 @@ class NotebookSSHServer(asyncssh.SSHServer):
         Connection has been successfully established
         """
         self._conn = conn
+        self.app.stats.incr("connections_total")
+        self.app.stats.incr("connections_active")
+        ACTIVE_CONNECTIONS.inc()
+        # Every phase of handling this connection is traced as part of
+        # the connection's span
+        self.connection_span = self.app.tracer.start_span(
+            "connection", peer=conn.get_extra_info("peername")[0]
+        )
+        self.key_exchange_span = self.app.tracer.start_span(
+            "key_exchange", parent=self.connection_span
+        )
+
+    def connection_lost(self, exc):
+        """
+        Connection has been closed
+        """
+        self.app.stats.decr("connections_active")
+        ACTIVE_CONNECTIONS.dec()
+        if exc is not None:
+            self.connection_span.set(error=repr(exc))
+        # Unless it ended as authentication began
+        self.key_exchange_span.end()
+        self.connection_span.end()
+
+    def begin_auth(self, username):
+        """
+        Key exchange is done & the client is about to authenticate
+        """
+        self.key_exchange_span.end()
+        return True
 
     def password_auth_supported(self):
         return True
 
-    async def get_user_server_url(self, session, username):
+    def public_key_auth_supported(self):
+        # Reading users' authorized keys takes a token of our own
+        return bool(self.app.api_token)
+
+    def auth_completed(self):
+        """
+        The client has logged in, proving it has the token or private key
+        """
+        if self.app.api_token:
+            # Only now, so nobody can make us create tokens without logging in
+            self.app.renew_user_token(self.username)
+        if self.public_key_login:
+            self.fill_terminal_pool()
+
+    @property
+    def auth_headers(self):
+        """
+        Headers authenticating requests as the user who is logging in.
+
+        Requests go through the app's shared HTTP client, so credentials are
+        passed per request rather than set on the client session.
+        """
+        return {"Authorization": f"token {self.token}"}
+
+    def send_auth_banner(self, msg):
+        """
+        Show msg to everyone waiting on the same server start as us
+        """
+        waiters = self.app.spawn_waiters.get(self.auth_cache_key, {self})
+        for server in waiters:
+            server._conn.send_auth_banner(msg)
+
+    @asynccontextmanager
+    async def hub_api_request(self, request, method, url):
+        """
+        Make a request to JupyterHub's REST API as the user
+
+        request names the kind of request in the hub API latency metric and
+        in its trace span. Both time how long JupyterHub took to respond,
+        not how long the response is then used for.
+        """
+        span = self.app.tracer.start_span(
+            "hub_request", parent=self.connection_span, request=request
+        )
+        with span:
+            start = time.perf_counter()
+            async with self.app.http_client.request(
+                method, url, headers=self.auth_headers
+            ) as resp:
+                HUB_API_DURATION_SECONDS.labels(
+                    request=request, status=resp.status
+                ).observe(time.perf_counter() - start)
+                span.end(status=resp.status)
+                yield resp
+
+    async def get_user_server_url(self, username):
         """
         Return user's server url if it is running.
 
         Else return None
         """
-        async with session.get(self.app.hub_url / "hub/api/users" / username) as resp:
+        async with self.hub_api_request(
+            "get_user", "GET", self.app.hub_url / "hub/api/users" / username
+        ) as resp:
             if resp.status != 200:
                 return None
             user = await resp.json()
@@ -52,13 +191,62 @@ class NotebookSSHServer(asyncssh.SSHServer):
             else:
                 return None
 
-    async def start_user_server(self, session, username):
+    async def follow_spawn_progress(self, username):
+        """
+        Wait for user's pending server using JupyterHub's progress events.
+
+        Progress messages are forwarded to the user as they arrive. Returns
+        the server url once it is ready, False if it failed to start, or None
+        if progress events aren't available and we should poll instead.
+        """
+        # REST API reference: https://jupyterhub.readthedocs.io/en/stable/_static/rest-api/index.html#operation--users--name--server-progress-get
+        progress_url = self.app.hub_url / "hub/api/users" / username / "server/progress"
+        async with self.hub_api_request("server_progress", "GET", progress_url) as resp:
+            if resp.status != 200:
+                return None
+            # The response is a stream of server-sent events, one JSON
+            # encoded event per 'data:' line
+            async for line in resp.content:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:") :])
+                if event.get("message"):
+                    self.send_auth_banner(f"\n{event['message']}")
+                if event.get("failed"):
+                    self.send_auth_banner("\n")
+                    return False
+                if event.get("ready"):
+                    self.send_auth_banner("\n")
+                    # URLs will have preceding slash, but yarl forbids those
+                    return self.app.hub_url / event["url"][1:]
+        # The stream ended without the server becoming ready
+        return None
+
+    async def poll_user_server_url(self, username):
+        """
+        Wait for user's pending server by polling for its url.
+
+        Polls back off exponentially, with jitter so many users waiting at
+        once don't poll JupyterHub in lockstep.
+        """
+        interval = self.app.spawn_poll_interval
+        notebook_url = None
+        while notebook_url is None:
+            with self.app.tracer.start_span("spawn_poll", parent=self.connection_span):
+                await asyncio.sleep(interval * random.uniform(0.5, 1))
+                interval = min(interval * 2, self.app.spawn_poll_max_interval)
+                notebook_url = await self.get_user_server_url(username)
+            self.send_auth_banner(".")
+        return notebook_url
+
+    async def start_user_server(self, username):
         """ """
         # REST API reference:       https://jupyterhub.readthedocs.io/en/stable/_static/rest-api/index.html#operation--users--name--server-post
         # REST API implementation:  https://github.com/jupyterhub/jupyterhub/blob/187fe911edce06eb067f736eaf4cc9ea52e69e08/jupyterhub/apihandlers/users.py#L451-L497
         create_url = self.app.hub_url / "hub/api/users" / username / "server"
 
-        async with session.post(create_url) as resp:
+        async with self.hub_api_request("start_server", "POST", create_url) as resp:
             if resp.status == 201 or resp.status == 400:
                 # FIXME: code 400 can mean "pending stop" or "already running",
                 #        but we assume it means that the server is already
@@ -72,25 +260,35 @@ class NotebookSSHServer(asyncssh.SSHServer):
             elif resp.status == 202:
                 # Server start has been requested, now and potentially earlier,
                 # but hasn't started quickly and is pending spawn.
-                # We check for a while, reporting progress to user - until we're
+                # We wait for it, reporting progress to user - until we're
                 # done
+                span = self.app.tracer.start_span(
+                    "spawn_wait", parent=self.connection_span
+                )
+                start = time.perf_counter()
+                status = "failure"
                 try:
                     async with timeout(self.app.start_timeout):
-                        notebook_url = None
-                        self._conn.send_auth_banner("Starting your server...")
-                        while notebook_url is None:
-                            # FIXME: Exponential backoff + make this configurable
-                            await asyncio.sleep(0.5)
-                            notebook_url = await self.get_user_server_url(
-                                session, username
-                            )
-                            self._conn.send_auth_banner(".")
-                        self._conn.send_auth_banner("done!\n")
+                        self.send_auth_banner("Starting your server...")
+                        notebook_url = await self.follow_spawn_progress(username)
+                        if notebook_url is None:
+                            notebook_url = await self.poll_user_server_url(username)
+                        if not notebook_url:
+                            self.send_auth_banner("failed to start server!\n")
+                            return None
+                        self.send_auth_banner("done!\n")
+                        status = "success"
                         return notebook_url
                 except asyncio.TimeoutError:
                     # Server didn't start on time!
-                    self._conn.send_auth_banner("failed to start server on time!\n")
+                    self.send_auth_banner("failed to start server on time!\n")
+                    status = "timeout"
                     return None
+                finally:
+                    SPAWN_WAIT_DURATION_SECONDS.labels(status=status).observe(
+                        time.perf_counter() - start
+                    )
+                    span.end(status=status)
             elif resp.status == 403:
                 # Token is wrong!
                 return None
@@ -98,70 +296,302 @@ class NotebookSSHServer(asyncssh.SSHServer):
                 # FIXME: Handle other cases that pop up
                 resp.raise_for_status()
 
+    async def start_user_server_once(self, username):
+        """
+        Start user's server, sharing the work with concurrent logins
+
+        Users often open several connections at once, and each of them asking
+        JupyterHub to start the server multiplies the load on it. Instead,
+        the first login does the work while later ones wait for its result,
+        and see the same progress messages. Logins are only grouped together
+        if they use the same token, as the result tells whether it is valid.
+        """
+        key = self.auth_cache_key
+        spawn = self.app.pending_spawns.get(key)
+        if spawn is None:
+            spawn = asyncio.ensure_future(self.start_user_server(username))
+            self.app.pending_spawns[key] = spawn
+            self.app.spawn_waiters[key] = set()
+            spawn.add_done_callback(partial(self.app.forget_pending_spawn, key))
+
+        waiters = self.app.spawn_waiters[key]
+        waiters.add(self)
+        try:
+            # Don't let this connection going away cancel the others' spawn
+            return await asyncio.shield(spawn)
+        finally:
+            waiters.discard(self)
+
     async def validate_password(self, username, token):
+        span = self.app.tracer.start_span(
+            "auth", parent=self.connection_span, username=username
+        )
+        start = time.perf_counter()
+        status = "failure"
+        try:
+            status = await self._validate_password(username, token)
+        finally:
+            AUTH_DURATION_SECONDS.labels(status=status).observe(
+                time.perf_counter() - start
+            )
+            span.end(status=status)
+        return status != "failure"
+
+    async def _validate_password(self, username, token):
+        """
+        Check token is valid for username, returning how it was checked
+
+        Returns 'cached' or 'success' if it is valid, 'failure' otherwise.
+        """
+        self.public_key_login = False
         self.username = username
         self.token = token
+        self.auth_cache_key = auth_cache_key(username, token)
 
-        headers = {"Authorization": f"token {token}"}
-        async with ClientSession(headers=headers) as session:
-            notebook_url = await self.start_user_server(session, username)
+        # A recent successful login with the same token tells us both that
+        # the token is valid and where the server is, so skip the hub
+        status = "cached"
+        notebook_url = self.app.auth_cache.get(self.auth_cache_key)
+        if notebook_url is None:
+            status = "success"
+            notebook_url = await self.start_user_server_once(username)
             if notebook_url is None:
-                return False
-            else:
-                self.notebook_url = notebook_url
-                return True
+                self.app.stats.incr("logins_failed")
+                return "failure"
+            self.app.auth_cache.set(self.auth_cache_key, notebook_url)
+
+        self.notebook_url = notebook_url
+        self.fill_terminal_pool()
+        return status
+
+    async def validate_public_key(self, username, key):
+        span = self.app.tracer.start_span(
+            "auth", parent=self.connection_span, username=username, method="publickey"
+        )
+        start = time.perf_counter()
+        status = "failure"
+        try:
+            status = await self._validate_public_key(username, key)
+        finally:
+            AUTH_DURATION_SECONDS.labels(status=status).observe(
+                time.perf_counter() - start
+            )
+            span.end(status=status)
+        return status != "failure"
 
-    async def _handle_ws_recv(self, stdout, data_packet):
+    async def _validate_public_key(self, username, key):
         """
-        Handle receiving a single data message from terminado.
+        Check key is one of username's authorized keys, returning how it was
+        checked
+
+        Returns 'cached' or 'success' if it is authorized, 'failure'
+        otherwise. Users must have a running server to log in with a key, as
+        their authorized keys are read from it, with a token created for them
+        when they last logged in.
         """
-        kind, data = data_packet
-        if kind == "setup":
-            # Signals we can get going now!
-            return
-        elif kind == "change":
-            # Sets terminal size, but let's ignore this for now
+        notebook_url, cached = await self.app.authorized_keys.lookup(
+            username, key.get_fingerprint("sha256")
+        )
+        if notebook_url is None:
+            return "failure"
+        # Never the app's own token, as users' servers are under their
+        # control and would see it
+        token = self.app.get_user_token(username)
+        if token is None:
+            return "failure"
+
+        # The client is yet to prove it has the private key, which asyncssh
+        # checks once we return
+        self.public_key_login = True
+        self.username = username
+        self.token = token
+        self.auth_cache_key = auth_cache_key(username, self.token)
+        self.notebook_url = notebook_url
+        return "cached" if cached else "success"
+
+    @property
+    def terminal_pool_key(self):
+        return (self.username, str(self.notebook_url))
+
+    def fill_terminal_pool(self):
+        """
+        Get spare terminals ready for this user's upcoming sessions
+        """
+        if self.app.terminal_pool_size > 0:
+            self.app.terminal_pool.fill(
+                self.terminal_pool_key, self.create_terminado, self.connect_terminado
+            )
+
+    def create_terminado(self):
+        """
+        Return a Terminado for the user's server, not yet started
+        """
+        compression = None
+        if self.app.websocket_compression and not self.app.uncompressed_users.get(
+            self.username
+        ):
+            compression = deflate_extension(
+                self.app.websocket_compression_window_bits,
+                self.app.websocket_compression_mem_level,
+                CompressionStats(
+                    self.app.websocket_compression_adaptive,
+                    self.app.websocket_compression_min_ratio,
+                ),
+            )
+        terminado = Terminado(
+            self.notebook_url,
+            self.token,
+            self.app.http_client,
+            max_size=self.app.websocket_max_size,
+            max_queue=self.app.websocket_max_queue,
+            read_limit=self.app.websocket_read_limit,
+            write_limit=self.app.websocket_write_limit,
+            compression=compression,
+        )
+        return terminado
+
+    async def connect_terminado(self, terminado):
+        """
+        Start terminado, then let the terminal sweeper keep track of it
+
+        Terminals that were created but failed to connect to are tracked
+        too, in case deleting them failed.
+        """
+        try:
+            await terminado.start()
+        finally:
+            if terminado.terminal_name is not None:
+                self.app.terminal_sweeper.track(terminado)
+
+    def report_compression(self, terminado):
+        """
+        Log how well a finished session's websocket messages compressed
+        """
+        if terminado.compression is None:
             return
-        elif kind == "disconnect":
-            # Not exactly sure what to do here?
+        stats = terminado.compression.stats
+        if not stats.negotiated:
             return
-        elif kind != "stdout":
-            raise ValueError(f"Unknown type {data[0]} received from terminado")
-        stdout.write(data)
-        await stdout.drain()
+        if stats.disabled_adaptively:
+            self.app.uncompressed_users.set(self.username, True)
+        self.app.log.info(
+            "Websocket compression for %s: %i bytes of messages took %i (%.1fx), "
+            "%.1fms CPU%s",
+            self.username,
+            stats.raw_bytes,
+            stats.compressed_bytes,
+            stats.ratio or 1,
+            stats.cpu_seconds * 1000,
+            ", turned off as it didn't pay off" if stats.disabled_adaptively else "",
+        )
+        if stats.ratio is not None:
+            WEBSOCKET_COMPRESSION_RATIO.observe(stats.ratio)
+        WEBSOCKET_COMPRESSION_CPU_SECONDS.inc(stats.cpu_seconds)
 
-    async def _handle_stdin(self, stdin, terminado):
+    async def start_terminado(self, span):
         """
-        Handle receiving a single byte from stdin
+        Return a connected Terminado, from the terminal pool if possible
 
-        We aren't buffering anything rn, but maybe we should?
+        span is the trace span to note whether a spare terminal was used in.
         """
-        while not stdin.at_eof():
-            try:
-                # Return *upto* 4096 bytes from the stdin buffer
-                # Returns pretty immediately - doesn't *wait* for 4096 bytes
-                # to be present in the buffer.
-                data = await stdin.read(4096)
-                await terminado.send_stdin(data)
-            except asyncssh.misc.TerminalSizeChanged as e:
-                await terminado.set_size(e.height, e.width)
-            except asyncssh.misc.BreakReceived:
-                pass
+        terminado = await self.app.terminal_pool.acquire(self.terminal_pool_key)
+        if terminado is not None:
+            span.set(pooled=True)
+            return terminado
+
+        span.set(pooled=False)
+        terminado = self.create_terminado()
+        try:
+            await self.connect_terminado(terminado)
+        except Exception:
+            # The user's server may have been stopped or the token revoked
+            # since we cached them, so make the next login ask the hub again
+            self.app.auth_cache.invalidate(self.auth_cache_key)
+            if self.public_key_login:
+                self.app.authorized_keys.invalidate(self.username)
+                self.app.user_tokens.invalidate(self.username)
+                self.app.renew_user_token(self.username)
+            raise
+        return terminado
+
+    async def _close_when_idle(self, output, input_batcher):
+        """
+        Return once neither output nor input was relayed for a while
+        """
+        idle_timeout = self.app.session_idle_timeout
+        while True:
+            last_activity = max(output.last_activity, input_batcher.last_activity)
+            idle = time.monotonic() - last_activity
+            if idle >= idle_timeout:
+                break
+            await asyncio.sleep(idle_timeout - idle)
+        await output.write(
+            f"\r\nClosing session after {idle_timeout:.0f} seconds of inactivity\r\n"
+        )
+
+    async def close_detached_session(self, key, session):
+        """
+        Close the terminal of a session nobody reattached to in time
+        """
+        if self.app.terminal_sessions.get(key) is session:
+            del self.app.terminal_sessions[key]
+        DETACHED_SESSIONS.dec()
+        try:
+            await session.terminado.close()
+        except Exception as e:
+            # Left for the terminal sweeper to delete
+            self.app.log.warning(
+                "Failed to close detached terminal of %s: %r", self.username, e
+            )
+        self.report_compression(session.terminado)
 
     async def _handle_client(self, stdin, stdout, stderr):
         """
         Handle data transfer once session has been fully established.
         """
-        async with ClientSession() as client, Terminado(
-            self.notebook_url, self.token, client
-        ) as terminado:
-
+        tracer = self.app.tracer
+        session_span = tracer.start_span("session", parent=self.connection_span)
+        # Ended once the user sees output, usually their shell's prompt
+        first_output_span = tracer.start_span("first_output", parent=session_span)
+        # Sessions the client named can be reattached to after disconnecting
+        session_key = None
+        if self.app.detach_grace_period > 0:
+            name = stdin.channel.get_environment().get(SESSION_ENV)
+            if name:
+                session_key = (self.username, name)
+        try:
+            with tracer.start_span("terminal_start", parent=session_span) as span:
+                session = self.app.terminal_sessions.get(session_key)
+                reattached = session is not None and session.alive
+                span.set(reattached=reattached)
+                if reattached:
+                    if session.detached:
+                        DETACHED_SESSIONS.dec()
+                else:
+                    session = TerminalSession(
+                        await self.start_terminado(span),
+                        self.app.scrollback_size if session_key else 0,
+                        self.app.log,
+                    )
+                    if session_key is not None:
+                        self.app.terminal_sessions[session_key] = session
+        except BaseException:
+            session_span.end()
+            raise
+        terminado = session.terminado
+        self.app.stats.incr("sessions_total")
+        self.app.stats.incr("sessions_active")
+        ACTIVE_SESSIONS.inc()
+        attachment = None
+        idle = None
+        try:
             # If a pty has been asked for, we tell terminado what the pty's current size is
             # Otherwise, terminado uses default size of 80x22
             channel = stdin.channel
             if channel.get_terminal_type():
-                rows, cols = channel.get_terminal_size()[:2]
-                await terminado.set_size(rows, rows)
+                # asyncssh reports the size as width & height
+                cols, rows = channel.get_terminal_size()[:2]
+                await terminado.set_size(rows, cols)
 
             # We run two tasks concurrently
             #
@@ -173,19 +603,39 @@ class NotebookSSHServer(asyncssh.SSHServer):
             # When either of these tasks exit, we want to:
             # 1. Clean up the other task
             # 2. (Ideally) close the terminal opened by terminado on the notebook server
+            #    (unless the session can be reattached to)
             # 3. Close the ssh connection
             #
             # We don't do all of these yet in a way that I can be satisfied with.
 
             # Pipe stdout from terminado to ssh
-            ws_to_stdout = asyncio.create_task(
-                terminado.on_receive(partial(self._handle_ws_recv, stdout))
+            output = OutputBatcher(
+                stdout,
+                self.app.output_flush_bytes,
+                self.app.output_flush_delay,
+                self.app.output_high_water,
+                first_output_span,
+                session.scrollback if session_key else None,
             )
+            if reattached:
+                # Show what the user missed, and what they saw before
+                stdout.write(session.scrollback.getvalue())
+                first_output_span.end()
+            attachment = session.attach(output)
             #
             # Pipe stdin from ssh to terminado
-            stdin_to_ws = asyncio.create_task(self._handle_stdin(stdin, terminado))
+            input_batcher = InputBatcher(
+                terminado,
+                self.app.input_flush_delay,
+                self.app.resize_delay,
+                self.app.input_buffer_limit,
+            )
+            stdin_to_ws = asyncio.create_task(input_batcher.relay(stdin))
 
-            tasks = [ws_to_stdout, stdin_to_ws]
+            tasks = [attachment, stdin_to_ws]
+            if self.app.session_idle_timeout > 0:
+                idle = asyncio.create_task(self._close_when_idle(output, input_batcher))
+                tasks.append(idle)
 
             # Wait for either pipe to be done
             done, pending = await asyncio.wait(
@@ -193,19 +643,110 @@ class NotebookSSHServer(asyncssh.SSHServer):
             )
 
             # At least one of the pipes is done.
-            # Close the ssh connection explicitly
+            # Send out whatever output is still queued, then close the ssh
+            # connection explicitly
+            output.write_buffer()
             self._conn.close()
 
             # Explicitly cancel the other tasks currently pending
             # FIXME: I don't know if this actually does anything?
             for t in pending:
-                t.cancel()
+                if t is not attachment:
+                    t.cancel()
+        finally:
+            self.app.stats.decr("sessions_active")
+            ACTIVE_SESSIONS.dec()
+            # The terminal ended, or another session took it over and relays
+            # it from now on
+            ended = attachment is not None and attachment.done()
+            taken_over = ended and attachment.result() == "taken_over"
+            # Keep the terminal around if the client disconnected, but not if
+            # it was closed for being idle
+            detach = all(
+                [
+                    attachment is not None,
+                    not ended,
+                    session_key is not None,
+                    session.alive,
+                    idle is None or not idle.done(),
+                    self.app.terminal_sessions.get(session_key) is session,
+                ]
+            )
 
-    def session_requested(self):
-        return self._handle_client
+            if detach:
+                session.detach(
+                    attachment,
+                    self.app.detach_grace_period,
+                    lambda: asyncio.ensure_future(
+                        self.close_detached_session(session_key, session)
+                    ),
+                )
+                DETACHED_SESSIONS.inc()
+            elif not taken_over:
+                if self.app.terminal_sessions.get(session_key) is session:
+                    del self.app.terminal_sessions[session_key]
+                with tracer.start_span("teardown", parent=session_span) as span:
+                    try:
+                        with tracer.start_span("terminal_close", parent=span):
+                            await terminado.close()
+                    except Exception as e:
+                        # Left for the terminal sweeper to delete
+                        self.app.log.warning(
+                            "Failed to close terminal of %s: %r", self.username, e
+                        )
+                    self.report_compression(terminado)
+                    # Get a terminal ready in case the user starts another session
+                    self.fill_terminal_pool()
+            first_output_span.end()
+            session_span.end(detached=detach)
+
+    def connection_requested(self, dest_host, dest_port, orig_host, orig_port):
+        """
+        Forward a channel opened with `ssh -L` to the user's server
+        """
+        if not self.app.port_forwarding_enabled:
+            raise asyncssh.ChannelOpenError(
+                asyncssh.OPEN_ADMINISTRATIVELY_PROHIBITED, "Port forwarding is disabled"
+            )
+        if proxy_prefix(dest_host, dest_port) is None:
+            raise asyncssh.ChannelOpenError(
+                asyncssh.OPEN_CONNECT_FAILED, f"Can't forward to {dest_host}"
+            )
+        span = self.app.tracer.start_span(
+            "forwarded_channel", parent=self.connection_span, port=dest_port
+        )
+        channel = self._conn.create_tcp_channel(
+            window=self.app.port_forwarding_window,
+            max_pktsize=min(
+                self.app.port_forwarding_window, self.app.ssh_max_packet_size
+            ),
+        )
+        return channel, ForwardedChannel(
+            self.app.forwarding_http_client,
+            self.notebook_url,
+            self.token,
+            dest_host,
+            dest_port,
+            self.forwarded_requests,
+            span,
+            self.app.log,
+        )
+
+
+def handle_session(stdin, stdout, stderr):
+    """
+    Handle a session with the NotebookSSHServer of its connection
+    """
+    server = stdin.channel.get_connection().get_owner()
+    return server._handle_client(stdin, stdout, stderr)
 
 
 class JupyterHubSSH(Application):
+    aliases = {
+        **Application.aliases,
+        "workers": "JupyterHubSSH.workers",
+    }
+
     config_file = Unicode(
         "jupyterhub_ssh_config.py",
         help="""
@@ -222,6 +763,121 @@ class JupyterHubSSH(Application):
         config=True,
     )
 
+    workers = Integer(
+        1,
+        help="""
+        Number of worker processes to run.
+
+        SSH key exchange and encryption are CPU bound, so a single process
+        can only make use of a single CPU core. With more than one worker, a
+        supervising process forks this many workers which all listen on the
+        same port (using SO_REUSEPORT), and restarts any of them that exit
+        unexpectedly.
+
+        Note that caches and spare terminals aren't shared between workers.
+        """,
+        config=True,
+    )
+
+    loop = Enum(
+        ["asyncio", "uvloop"],
+        "asyncio",
+        help="""
+        Event loop to serve connections with, either asyncio's own or
+        uvloop.
+
+        We spend most of our time relaying bytes between sockets, which
+        uvloop does with less overhead. It must be installed separately,
+        e.g. with `pip install jupyterhub-ssh[speedups]`.
+        """,
+        config=True,
+    )
+
+    event_loop_lag_threshold = Float(
+        0.25,
+        help="""
+        Seconds the event loop may be blocked for before we log what blocked
+        it.
+
+        Anything blocking the event loop delays every connection served by
+        it. While it is blocked for longer than this, a separate thread
+        samples what the event loop is running, to be logged once it is
+        done.
+
+        Set to 0 to not look for what blocks the event loop. Its lag is
+        still measured when serving metrics.
+        """,
+        config=True,
+    )
+
+    worker_stats_interval = Float(
+        60,
+        help="""
+        Seconds between logging stats summed over all workers, when running
+        more than one worker.
+
+        Set to 0 to not log stats.
+        """,
+        config=True,
+    )
+
+    metrics_port = Integer(
+        0,
+        help="""
+        Port to serve Prometheus metrics on, over HTTP at any path.
+
+        Set to 0 to not serve metrics.
+
+        When running more than one worker, the PROMETHEUS_MULTIPROC_DIR
+        environment variable must be set to a directory workers can write
+        their metrics to, which is cleared on startup.
+        """,
+        config=True,
+    )
+
+    trace_file = Unicode(
+        "",
+        help="""
+        File to append a trace of each connection to, as JSON lines.
+
+        Each connection gets a trace id, and spans timing key exchange,
+        authentication, requests to JupyterHub, waiting for servers to start,
+        starting & closing terminals, the time until a session's first output
+        and its teardown.
+
+        Tracing is off unless this or `trace_otlp_endpoint` is set.
+        """,
+        config=True,
+    )
+
+    trace_otlp_endpoint = Unicode(
+        "",
+        help="""
+        URL of an OpenTelemetry collector to send traces of connections to,
+        with OTLP over HTTP & JSON. For example, `http://localhost:4318`.
+
+        See `trace_file` for what is traced.
+        """,
+        config=True,
+    )
+
+    trace_otlp_interval = Float(
+        5,
+        help="""
+        Seconds between sending batches of traces to `trace_otlp_endpoint`.
+        """,
+        config=True,
+    )
+
+    metrics_ip = Unicode(
+        "",
+        help="""
+        IP address to serve Prometheus metrics on. Defaults to all
+        interfaces.
+        """,
+        config=True,
+    )
+
     debug = Bool(
         True,
         help="""
@@ -273,7 +929,147 @@ class JupyterHubSSH(Application):
         help="""
         Path to host's private SSH Key.
 
-        *Must* be set.
+        Kept for backwards compatibility, it is used along with the keys in
+        `host_key_paths`.
+        """,
+        config=True,
+    )
+
+    host_key_paths = List(
+        Unicode(),
+        help="""
+        Paths to host's private SSH keys, of different types.
+
+        Clients pick which type of host key they want the server to prove its
+        identity with. Signing with RSA keys is much slower than with Ed25519
+        or ECDSA keys, which limits how many logins a second a worker can
+        handle, so having a key of one of these types available speeds up
+        logins of the many clients that prefer them.
+
+        Keys of `host_key_types` that aren't among these are generated at
+        startup.
+        """,
+        config=True,
+    )
+
+    host_key_types = List(
+        Unicode(),
+        ["ssh-ed25519", "ecdsa-sha2-nistp256"],
+        help="""
+        Types of host keys to always have, in order of preference.
+
+        If `host_key_dir` is set, a key is generated there for each type no
+        key in `host_key_paths` or `host_key_path` is of. Otherwise missing
+        types are skipped, as keys generated at every start would differ
+        between restarts and replicas. Clients learn about all our host keys
+        and remember them, so would then warn users that the host's identity
+        changed.
+
+        Keys are offered to clients in this order, followed by keys of other
+        types.
+        """,
+        config=True,
+    )
+
+    host_key_dir = Unicode(
+        "",
+        help="""
+        Directory to keep generated host keys in, see `host_key_types`.
+
+        Keys generated once are read from here on later startups, so clients
+        see the same host keys every time. If running more than one replica
+        behind the same address, they must all share this directory.
+        """,
+        config=True,
+    )
+
+    kex_algs = List(
+        Unicode(),
+        help="""
+        Key exchange algorithms to allow, in order of preference. For
+        example, `["curve25519-sha256", "ecdh-sha2-nistp256"]` to only allow
+        the fastest ones.
+
+        Clients use the first algorithm of their own preferred order that
+        the server allows, so this mostly limits what clients can pick.
+
+        Defaults to asyncssh's defaults.
+        """,
+        config=True,
+    )
+
+    signature_algs = List(
+        Unicode(),
+        help="""
+        Signature algorithms to allow for host keys, in order of
+        preference. For example, `["ssh-ed25519", "rsa-sha2-256"]`.
+
+        Like `kex_algs`, this mostly limits what clients can pick.
+
+        Defaults to asyncssh's defaults.
+        """,
+        config=True,
+    )
+
+    api_token = Unicode(
+        "",
+        help="""
+        Token of a JupyterHub service jupyterhub-ssh can read users' authorized
+        SSH keys with, allowing users to log in with SSH keys as well as with
+        tokens.
+
+        The service needs the `read:users`, `read:servers`, `access:servers`
+        and `tokens` scopes. This token is only ever sent to the hub, never to
+        users' servers. It is used to create tokens for users, limited to
+        accessing their own server, to read their authorized keys and to run
+        the sessions they log in to with a key. See `user_token_lifetime`.
+
+        Tokens are only created for users once they have logged in, so users
+        have to log in with a JupyterHub token before they can log in with a
+        key, and again if they haven't logged in for a while.
+
+        Authorized keys are read from `authorized_keys_path` on users' servers,
+        so users can only log in with a key while their server is running.
+        Keys with options (like `from=` or `command=`) are ignored.
+        """,
+        config=True,
+    )
+
+    user_token_lifetime = Integer(
+        86400,
+        help="""
+        Seconds tokens created for users logging in with SSH keys are valid
+        for. See `api_token`.
+
+        A user's token is replaced when they log in once a quarter of this
+        time has passed, and no longer used for new logins once half of it
+        has, so a session started with one can keep using it for at least
+        the second half. Users who haven't logged in for half of this time
+        have to log in with a JupyterHub token again before they can use
+        their key.
+        """,
+        config=True,
+    )
+
+    authorized_keys_path = Unicode(
+        ".ssh/authorized_keys",
+        help="""
+        Path of the file with users' authorized SSH keys, relative to the root
+        of their server's Contents API (usually their home directory). See
+        `api_token`.
+        """,
+        config=True,
+    )
+
+    authorized_keys_ttl = Float(
+        300,
+        help="""
+        Seconds to remember users' authorized keys for.
+
+        Keys are fetched again in the background when a user logs in after
+        half this time, so logins with keys rarely wait for them to be
+        fetched. Keys removed from a user's authorized_keys file may still be
+        accepted for this long.
         """,
         config=True,
     )
@@ -287,6 +1083,491 @@ class JupyterHubSSH(Application):
         config=True,
     )
 
+    spawn_poll_interval = Float(
+        0.5,
+        help="""
+        Seconds to wait before first checking again on a server pending
+        spawn, when JupyterHub's progress events aren't available.
+
+        The wait doubles after each check, up to `spawn_poll_max_interval`.
+        """,
+        config=True,
+    )
+
+    spawn_poll_max_interval = Float(
+        5,
+        help="""
+        Maximum seconds to wait between checks on a server pending spawn, see
+        `spawn_poll_interval`.
+        """,
+        config=True,
+    )
+
+    output_flush_bytes = Integer(
+        16384,
+        help="""
+        Bytes of terminal output to collect before writing them to the SSH
+        channel in one go. See `output_flush_delay`.
+        """,
+        config=True,
+    )
+
+    output_flush_delay = Float(
+        0.0005,
+        help="""
+        Maximum seconds terminal output is held back to be merged with more
+        output, before it is written to the SSH channel.
+
+        Merging the many small messages terminado sends while a program
+        produces lots of output saves an SSH packet and a syscall per message.
+        """,
+        config=True,
+    )
+
+    output_high_water = Integer(
+        65536,
+        help="""
+        Bytes of output waiting to be sent on an SSH channel above which we
+        stop reading more terminal output until it has been sent.
+
+        Terminal output then queues up in the websocket to terminado, up to
+        `websocket_max_queue` messages, after which we stop reading from the
+        websocket. This makes a slow SSH client slow down the terminal
+        instead of growing our memory use.
+        """,
+        config=True,
+    )
+
+    ssh_window = Integer(
+        2 * 1024 * 1024,
+        help="""
+        Bytes an SSH client may send on each channel before waiting for us to
+        take them, i.e. the SSH window of each session's channel.
+
+        Input we haven't taken yet is buffered, so this bounds the memory a
+        client sending faster than its terminal reads can make us use, per
+        session. Smaller windows slow down bulk transfers like SFTP uploads
+        over high latency connections, which can send at most a window's
+        worth of data per round trip.
+        """,
+        config=True,
+    )
+
+    ssh_max_packet_size = Integer(
+        32768,
+        help="""
+        Maximum size in bytes of SSH packets' data on each channel, in both
+        directions. Should not be more than `ssh_window`.
+        """,
+        config=True,
+    )
+
+    input_buffer_limit = Integer(
+        65536,
+        help="""
+        Bytes of input from an SSH client to hold while waiting to send it to
+        the terminal, above which we stop reading input from the client.
+
+        The SSH client then stops sending more once the SSH channel's window
+        is used up.
+        """,
+        config=True,
+    )
+
+    websocket_max_size = Integer(
+        2**20,
+        help="""
+        Maximum size in bytes of messages from terminado. Terminals sending
+        larger messages are disconnected.
+
+        Messages are buffered in full before being relayed, so together with
+        `websocket_max_queue` this bounds the memory each session's
+        websocket may use.
+        """,
+        config=True,
+    )
+
+    websocket_max_queue = Integer(
+        4,
+        help="""
+        Maximum number of messages from terminado to queue in each session's
+        websocket, when terminal output comes in faster than the SSH client
+        takes it.
+
+        Once this many are queued, nothing more is read from the websocket
+        until the session reads some, which is how output from terminals
+        that are pooled, detached or written faster than the SSH client
+        takes it is held back. Websockets to terminado therefore don't send
+        keepalive pings, whose pongs wouldn't be read.
+        """,
+        config=True,
+    )
+
+    websocket_read_limit = Integer(
+        65536,
+        help="""
+        Bytes read from each session's websocket to terminado that may be
+        buffered before being parsed into messages.
+        """,
+        config=True,
+    )
+
+    websocket_write_limit = Integer(
+        65536,
+        help="""
+        Bytes of input waiting to be sent on each session's websocket to
+        terminado above which we stop sending more until it has been sent.
+        """,
+        config=True,
+    )
+
+    websocket_compression = Bool(
+        True,
+        help="""
+        Offer to compress messages on websockets to terminado with
+        permessage-deflate.
+
+        Terminal output usually compresses very well, saving bandwidth
+        between us and users' servers at the cost of some CPU on both ends.
+        Users' servers only compress if they are configured to, e.g. with
+        `c.ServerApp.tornado_settings = {"websocket_compression_options": {}}`.
+        """,
+        config=True,
+    )
+
+    websocket_compression_window_bits = Integer(
+        15,
+        help="""
+        Base two logarithm of the window size used to compress websocket
+        messages, between 8 and 15.
+
+        Smaller windows use less memory per session on both ends, but
+        compress less well.
+        """,
+        config=True,
+    )
+
+    @validate("websocket_compression_window_bits")
+    def _validate_websocket_compression_window_bits(self, proposal):
+        if not 8 <= proposal.value <= 15:
+            raise ValueError("websocket_compression_window_bits must be 8 to 15")
+        return proposal.value
+
+    websocket_compression_mem_level = Integer(
+        5,
+        help="""
+        Memory level, between 1 and 9, used to compress websocket messages we
+        send. Higher levels use more memory for faster, better compression.
+        """,
+        config=True,
+    )
+
+    @validate("websocket_compression_mem_level")
+    def _validate_websocket_compression_mem_level(self, proposal):
+        if not 1 <= proposal.value <= 9:
+            raise ValueError("websocket_compression_mem_level must be 1 to 9")
+        return proposal.value
+
+    websocket_compression_adaptive = Bool(
+        False,
+        help="""
+        Stop compressing websocket messages for sessions whose terminal
+        output doesn't compress well, see
+        `websocket_compression_min_ratio`.
+
+        Once a session's first 64 KiB don't compress well enough, we stop
+        compressing what we send, and don't offer compression for the user's
+        sessions started within the next hour.
+        """,
+        config=True,
+    )
+
+    websocket_compression_min_ratio = Float(
+        2,
+        help="""
+        Factor by which websocket messages must shrink when compressed for
+        compression to be kept on, when `websocket_compression_adaptive` is
+        set.
+        """,
+        config=True,
+    )
+
+    input_flush_delay = Float(
+        0.001,
+        help="""
+        Seconds to wait for more input after receiving some from an SSH
+        client, so it can be sent to the terminal together.
+
+        Pastes and fast typing otherwise produce a message to the terminal per
+        small chunk of input.
+        """,
+        config=True,
+    )
+
+    resize_delay = Float(
+        0.05,
+        help="""
+        Seconds to wait for further terminal size changes after the SSH client
+        reports one, before resizing the terminal to the latest size.
+        """,
+        config=True,
+    )
+
+    terminal_sweep_interval = Float(
+        60,
+        help="""
+        Seconds between checks for terminals we created that were left
+        behind on users' servers, e.g. when deleting them at the end of a
+        session failed. Those that are found are deleted.
+
+        Set to 0 to not check.
+        """,
+        config=True,
+    )
+
+    session_idle_timeout = Float(
+        0,
+        help="""
+        Seconds after which sessions without any input or output are closed,
+        deleting their terminal.
+
+        Set to 0 to never close idle sessions.
+        """,
+        config=True,
+    )
+
+    detach_grace_period = Float(
+        0,
+        help="""
+        Seconds to keep a session's terminal running after its SSH connection
+        is lost, so the user can reattach to it.
+
+        Only sessions the client names are kept, with the
+        JUPYTERHUB_SSH_SESSION environment variable. For example, after
+        `ssh -o SetEnv=JUPYTERHUB_SSH_SESSION=work ...` drops, running the
+        same command again reattaches to the same shell, showing the output
+        missed in between (see `scrollback_size`). Reattaching takes over
+        the session from any other connection still attached to it.
+
+        Detached sessions are only known to the process that served them,
+        so this can't be used with more than one of `workers`: reconnecting
+        would most likely reach another worker, which couldn't reattach.
+        Likewise, with several replicas behind a load balancer, reconnecting
+        only reattaches if it reaches the same replica.
+
+        Set to 0 to close terminals as soon as their session ends.
+        """,
+        config=True,
+    )
+
+    scrollback_size = Integer(
+        65536,
+        help="""
+        Bytes of recent output to keep for each named session, to show again
+        when reattaching to it. See `detach_grace_period`.
+        """,
+        config=True,
+    )
+
+    terminal_pool_size = Integer(
+        0,
+        help="""
+        Number of spare terminals to keep ready for each user who recently
+        logged in or ended a session.
+
+        New sessions take a spare terminal if there is one, instead of
+        creating one and waiting for its shell to start, so users see a prompt
+        sooner. Each spare terminal is a running shell on the user's server
+        though, see `terminal_pool_idle_timeout`.
+
+        Set to 0 to not keep spare terminals.
+        """,
+        config=True,
+    )
+
+    terminal_pool_idle_timeout = Float(
+        300,
+        help="""
+        Seconds a spare terminal is kept for before it is closed if no session
+        took it. See `terminal_pool_size`.
+        """,
+        config=True,
+    )
+
+    sftp_enabled = Bool(
+        False,
+        help="""
+        Serve SFTP, giving access to the files on users' servers.
+
+        Files are accessed through the Contents API of the users' servers,
+        so unlike with jupyterhub-sftp, no access to the storage of their home
+        directories is needed.
+        """,
+        config=True,
+    )
+
+    sftp_upload_chunk_size = Integer(
+        8 * 1024 * 1024,
+        help="""
+        Bytes of a file uploaded via SFTP to collect before sending them to
+        the user's server as one chunk.
+
+        This caps the memory needed per upload. Note that chunks are sent
+        base64 encoded, so requests are about a third larger than this, and
+        must fit within the user server's maximum request body size.
+        """,
+        config=True,
+    )
+
+    sftp_metadata_cache_ttl = Float(
+        5,
+        help="""
+        Seconds to remember metadata of files and directories fetched during
+        an SFTP session, so listing the same directories over and over
+        doesn't fetch them from the user's server each time.
+
+        Metadata of paths is forgotten right away when they are changed
+        through the same session.
+        """,
+        config=True,
+    )
+
+    port_forwarding_enabled = Bool(
+        False,
+        help="""
+        Allow users to forward local ports to their server, with `ssh -L`.
+
+        Forwarded connections must speak HTTP (or websockets), as they reach
+        the user's server through JupyterHub's proxy: a connection forwarded
+        to port 6006 on localhost is sent to /proxy/6006/ of the user's
+        server, so jupyter-server-proxy must be installed there. Forwarding
+        to other hosts is up to jupyter-server-proxy's host allowlist.
+        """,
+        config=True,
+    )
+
+    port_forwarding_max_requests = Integer(
+        8,
+        help="""
+        Maximum number of HTTP requests forwarded at once over the forwarded
+        channels of a single SSH connection, see `port_forwarding_enabled`.
+        Further requests wait for these to get their response.
+
+        Websocket upgrades only count while connecting, not for as long as
+        the websocket stays open.
+        """,
+        config=True,
+    )
+
+    port_forwarding_window = Integer(
+        2 * 1024 * 1024,
+        help="""
+        Bytes a forwarded channel may send us before we have passed them
+        on, i.e. the SSH window of each forwarded channel. This bounds the
+        memory a forwarded upload can take up when the user's server reads
+        it slower than the client sends it.
+        """,
+        config=True,
+    )
+
+    http_pool_limit = Integer(
+        100,
+        help="""
+        Maximum number of simultaneous HTTP connections kept open to
+        JupyterHub and the users' servers, shared by all SSH connections.
+
+        Set to 0 for no limit.
+        """,
+        config=True,
+    )
+
+    http_pool_limit_per_host = Integer(
+        0,
+        help="""
+        Maximum number of simultaneous HTTP connections kept open to a single
+        host. As all traffic usually goes through JupyterHub's proxy, this
+        effectively caps the connections to it.
+
+        Set to 0 for no limit other than `http_pool_limit`.
+        """,
+        config=True,
+    )
+
+    http_keepalive_timeout = Float(
+        15,
+        help="""
+        Seconds an idle HTTP connection is kept open for reuse by later
+        requests before being closed.
+        """,
+        config=True,
+    )
+
+    http_dns_cache_ttl = Integer(
+        10,
+        help="""
+        Seconds to cache DNS lookups of JupyterHub's proxy for.
+
+        Set to 0 to disable caching.
+        """,
+        config=True,
+    )
+
+    auth_cache_ttl = Float(
+        60,
+        help="""
+        Seconds to remember a successful login for.
+
+        A user reconnecting with the same token within this time is let in
+        without asking JupyterHub to validate the token or start their server
+        again, which matters for tools that reconnect often. A revoked token
+        or stopped server may therefore go unnoticed for this long, though
+        failing to open a terminal on a remembered server forgets it right
+        away.
+
+        Set to 0 to always ask JupyterHub.
+        """,
+        config=True,
+    )
+
+    auth_cache_max_size = Integer(
+        10000,
+        help="""
+        Maximum number of logins to remember, see `auth_cache_ttl`. The least
+        recently used logins are forgotten first.
+        """,
+        config=True,
+    )
+
+    def init_http_client(self):
+        """
+        Create the HTTP client shared by all SSH connections
+
+        Connections to JupyterHub's proxy are pooled and kept alive, so
+        logins and sessions don't pay for a new DNS lookup and TCP / TLS
+        handshake on every request. Credentials are passed per request and
+        cookies are never kept, so the client carries no user specific state.
+        """
+        connector = TCPConnector(
+            limit=self.http_pool_limit,
+            limit_per_host=self.http_pool_limit_per_host,
+            keepalive_timeout=self.http_keepalive_timeout,
+            use_dns_cache=self.http_dns_cache_ttl > 0,
+            ttl_dns_cache=self.http_dns_cache_ttl or None,
+        )
+        # Never keep cookies, which one user's server could otherwise set
+        # for requests made on behalf of every other user
+        self.http_client = ClientSession(
+            connector=connector, cookie_jar=DummyCookieJar()
+        )
+        # Forwarded requests share the pool, and have their responses passed
+        # on as they are
+        self.forwarding_http_client = ClientSession(
+            connector=connector,
+            connector_owner=False,
+            cookie_jar=DummyCookieJar(),
+            auto_decompress=False,
+        )
+
     def init_logging(self):
         """
         Make traitlets & asyncssh logging work properly
@@ -306,27 +1587,317 @@ class JupyterHubSSH(Application):
         asyncssh_logger.parent = self.log
         asyncssh_logger.setLevel(self.log.level)
 
+    def init_host_keys(self):
+        """
+        Load our host keys, generating keys of missing host_key_types in
+        host_key_dir
+
+        Done before workers are forked, so they all have the same keys.
+        """
+        paths = list(self.host_key_paths)
+        if self.host_key_path:
+            paths.append(self.host_key_path)
+        keys = [asyncssh.read_private_key(path) for path in paths]
+
+        types = {key.get_algorithm() for key in keys}
+        for key_type in self.host_key_types:
+            if key_type in types:
+                continue
+            if not self.host_key_dir:
+                # Keys generated now would change on restart
+                self.log.info(
+                    "No %s host key, as host_key_dir isn't set to keep it in",
+                    key_type,
+                )
+                continue
+
+            path = os.path.join(
+                self.host_key_dir, f"ssh_host_{key_type.replace('ssh-', '')}_key"
+            )
+            if os.path.exists(path):
+                keys.append(asyncssh.read_private_key(path))
+                continue
+            self.log.info("Generating %s host key at %s", key_type, path)
+            key = asyncssh.generate_private_key(key_type)
+            # Readable by us only, like sshd's host keys
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with open(fd, "wb") as f:
+                f.write(key.export_private_key())
+            keys.append(key)
+
+        if not keys:
+            self.log.critical("host_key_paths or host_key_dir must be set")
+            self.exit(1)
+
+        def preference(key):
+            if key.get_algorithm() in self.host_key_types:
+                return self.host_key_types.index(key.get_algorithm())
+            return len(self.host_key_types)
+
+        self.host_keys = sorted(keys, key=preference)
+
     def initialize(self, *args, **kwargs):
         super().initialize(*args, **kwargs)
         self.load_config_file(self.config_file)
         self.init_logging()
+        self.init_host_keys()
+        # Created before workers are forked, so they can all report to us
+        self.stats = WorkerStats(self.workers)
+        self.auth_cache = TTLCache(self.auth_cache_ttl, self.auth_cache_max_size)
+        # Server starts in progress, and the connections waiting for them,
+        # keyed like auth_cache
+        self.pending_spawns = {}
+        self.spawn_waiters = {}
+        self.terminal_pool = TerminalPool(
+            self.terminal_pool_size, self.terminal_pool_idle_timeout, self.log
+        )
+        self.terminal_sweeper = TerminalSweeper(self.terminal_sweep_interval, self.log)
+        self.authorized_keys = AuthorizedKeysIndex(
+            self.fetch_authorized_keys,
+            self.authorized_keys_ttl,
+            self.auth_cache_max_size,
+            self.log,
+        )
+        # Tokens for users' own servers & when they were created, by
+        # username. See renew_user_token.
+        self.user_tokens = TTLCache(
+            self.user_token_lifetime / 2, self.auth_cache_max_size
+        )
+        self.pending_user_tokens = {}
+        # Sessions that can be reattached to, by username & session name
+        self.terminal_sessions = {}
+        # Users whose terminal output recently didn't compress well
+        self.uncompressed_users = TTLCache(3600, self.auth_cache_max_size)
+
+    def get_user_token(self, username):
+        """
+        Return the token created for username, or None if there is none
+
+        Tokens are only ever created by renew_user_token, once a user has
+        logged in, so this never asks the hub for one.
+        """
+        entry = self.user_tokens.get(username)
+        return None if entry is None else entry[0]
+
+    def renew_user_token(self, username):
+        """
+        Create a token only allowing access to username's own server in the
+        background, unless theirs is recent
+
+        Must only be called once username has logged in, so nobody can make
+        us create tokens without being able to log in. Tokens are created
+        with the hub's API using `api_token`, and replaced once a quarter of
+        `user_token_lifetime` has passed, so users logging in regularly
+        always have one. Concurrent renewals for the same user share one
+        token.
+        """
+        entry = self.user_tokens.get(username)
+        renew_after = self.user_token_lifetime / 4
+        if entry is not None and time.monotonic() - entry[1] < renew_after:
+            return
+        if username in self.pending_user_tokens:
+            return
+        create = asyncio.ensure_future(self.create_user_token(username))
+        self.pending_user_tokens[username] = create
+
+        def done(create):
+            del self.pending_user_tokens[username]
+            if not create.cancelled() and create.exception() is not None:
+                self.log.warning(
+                    "Failed to create token for %s: %r", username, create.exception()
+                )
+
+        create.add_done_callback(done)
+
+    async def create_user_token(self, username):
+        headers = {"Authorization": f"token {self.api_token}"}
+        url = self.hub_url / "hub/api/users" / username / "tokens"
+        body = {
+            "note": "jupyterhub-ssh key login",
+            "expires_in": self.user_token_lifetime,
+            "scopes": [f"access:servers!user={username}"],
+        }
+        created = time.monotonic()
+        async with self.http_client.post(url, json=body, headers=headers) as resp:
+            resp.raise_for_status()
+            token = (await resp.json())["token"]
+        self.user_tokens.set(username, (token, created))
+        return token
+
+    async def fetch_authorized_keys(self, username):
+        """
+        Return URL of username's server & their authorized_keys file there,
+        or None if they have no running server
+        """
+        headers = {"Authorization": f"token {self.api_token}"}
+        url = self.hub_url / "hub/api/users" / username
+        async with self.http_client.get(url, headers=headers) as resp:
+            if resp.status == 404:
+                return None
+            resp.raise_for_status()
+            user = await resp.json()
+        server = user.get("servers", {}).get("", {})
+        if not server.get("ready", False):
+            return None
+        # URLs will have preceding slash, but yarl forbids those
+        notebook_url = self.hub_url / server["url"][1:]
+
+        # The user's server is theirs to control, so only ever gets a token
+        # of theirs. Those are only created once they logged in, as whoever
+        # looks up a key hasn't proven they have the private key yet.
+        token = self.get_user_token(username)
+        if token is None:
+            self.log.info(
+                "Can't read authorized keys of %s until they log in with a token",
+                username,
+            )
+            return None
+        headers = {"Authorization": f"token {token}"}
+        url = notebook_url / "api/contents" / self.authorized_keys_path
+        params = {"type": "file", "format": "text", "content": "1"}
+        async with self.http_client.get(url, params=params, headers=headers) as resp:
+            if resp.status == 404:
+                return notebook_url, ""
+            resp.raise_for_status()
+            model = await resp.json()
+        return notebook_url, model["content"]
+
+    def forget_pending_spawn(self, key, spawn):
+        """
+        Stop tracking a server start once it is done
+        """
+        self.pending_spawns.pop(key, None)
+        self.spawn_waiters.pop(key, None)
+
+    def init_tracer(self):
+        exporters = []
+        if self.trace_file:
+            exporters.append(JSONLinesExporter(self.trace_file))
+        if self.trace_otlp_endpoint:
+            exporters.append(
+                OTLPExporter(
+                    self.trace_otlp_endpoint,
+                    self.http_client,
+                    self.trace_otlp_interval,
+                    self.log,
+                )
+            )
+        if exporters:
+            self.tracer = Tracer(exporters)
+        else:
+            self.tracer = NullTracer()
 
     async def start_server(self):
-        await asyncssh.listen(
+        # aiohttp wants its client to be created from within the event loop
+        self.init_http_client()
+        self.init_tracer()
+        self.server = await asyncssh.listen(
             host="",
             port=self.port,
             server_factory=partial(NotebookSSHServer, self),
+            session_factory=handle_session,
+            sftp_factory=ContentsSFTPServer if self.sftp_enabled else None,
+            sftp_version=3,
             line_editor=False,
+            # Sessions relay bytes, which we only decode & encode where
+            # they meet terminado's JSON messages
+            encoding=None,
             password_auth=True,
-            server_host_keys=[self.host_key_path],
+            server_host_keys=self.host_keys,
+            # Lets clients learn about all of our host keys, so those that
+            # know just one of them can switch to a faster one
+            send_server_host_keys=True,
+            kex_algs=self.kex_algs or (),
+            signature_algs=self.signature_algs or (),
+            window=self.ssh_window,
+            max_pktsize=self.ssh_max_packet_size,
             agent_forwarding=False,  # The cause of so much pain! Let's not allow this by default
             keepalive_interval=30,  # FIXME: Make this configurable
+            # Let all workers listen on the same port
+            reuse_port=self.workers > 1,
         )
+        self.watchdog = None
+        if self.metrics_port or self.event_loop_lag_threshold > 0:
+            self.watchdog = LoopWatchdog(self.event_loop_lag_threshold, log=self.log)
+            self.watchdog.start()
+        if self.terminal_sweep_interval > 0:
+            asyncio.ensure_future(self.terminal_sweeper.run())
+
+    async def stop_server(self):
+        """
+        Stop accepting connections, and send off what is left to send
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        # Exporters may still need the HTTP client to send the last spans
+        await self.tracer.close()
+        await self.forwarding_http_client.close()
+        await self.http_client.close()
+
+    async def serve(self):
+        """
+        Serve SSH connections until told to stop with SIGTERM or SIGINT
+        """
+        await self.start_server()
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, stopped.set)
+            except NotImplementedError:
+                # On Windows, where KeyboardInterrupt stops us instead
+                pass
+        try:
+            await stopped.wait()
+        finally:
+            await self.stop_server()
+
+    def run_worker(self):
+        """
+        Serve SSH connections from this process until stopped
+        """
+        asyncio.run(self.serve())
+
+    def start(self):
+        if self.loop == "uvloop":
+            if uvloop is None:
+                self.log.critical("uvloop must be installed to use it as event loop")
+                self.exit(1)
+            # Inherited by workers, which create their event loop once forked
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        if self.workers > 1:
+            if self.detach_grace_period > 0:
+                self.log.critical(
+                    "detach_grace_period can't be used with more than one worker"
+                )
+                self.exit(1)
+            if self.metrics_port:
+                if not multiprocess_enabled():
+                    self.log.critical(
+                        "PROMETHEUS_MULTIPROC_DIR must be set to serve metrics "
+                        "with more than one worker"
+                    )
+                    self.exit(1)
+                clear_multiprocess_dir()
+                start_metrics_server(self.metrics_port, self.metrics_ip)
+            supervisor = Supervisor(
+                self.workers,
+                self.run_worker,
+                self.stats,
+                self.log,
+                self.worker_stats_interval,
+                on_worker_exit=mark_worker_dead,
+            )
+            supervisor.run()
+        else:
+            if self.metrics_port:
+                start_metrics_server(self.metrics_port, self.metrics_ip)
+            self.run_worker()
 
 
 def main():
     app = JupyterHubSSH()
     app.initialize()
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(app.start_server())
-    loop.run_forever()
+    app.start()
@@ -0,0 +1,61 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+
+def auth_cache_key(username, token):
+    """
+    Return the key to cache results of authenticating username with token
+
+    Only a hash of the token is kept around, so tokens don't linger in
+    memory for longer than the SSH connections using them.
+    """
+    return (username, hashlib.sha256(token.encode("utf-8")).hexdigest())
+
+
+class TTLCache:
+    """
+    A bounded mapping whose entries expire after a fixed time
+
+    When full, the least recently used entry is evicted to make room for new
+    ones. Expired entries are dropped lazily as they are looked up.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return value cached for key, or None if it is missing or has expired
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """
+        Cache value for key, evicting the least recently used entry if full
+        """
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Forget whatever is cached for key
+        """
+        self._entries.pop(key, None)
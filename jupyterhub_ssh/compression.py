@@ -0,0 +1,143 @@
+import time
+
+from websockets.extensions.base import Extension
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+from websockets.frames import CTRL_OPCODES
+
+
+class CompressionStats:
+    """
+    How well a websocket's messages compressed, and what it cost us
+
+    Bytes are counted before compression (raw) and on the wire (compressed)
+    for data frames in both directions, along with the CPU time spent
+    compressing & decompressing them.
+
+    If adaptive, compression of outgoing messages is turned off once
+    sample_bytes have been relayed and they didn't compress by
+    at least min_ratio.
+    """
+
+    __slots__ = (
+        "adaptive",
+        "min_ratio",
+        "negotiated",
+        "compress_outgoing",
+        "raw_bytes",
+        "compressed_bytes",
+        "cpu_seconds",
+    )
+
+    sample_bytes = 65536
+
+    def __init__(self, adaptive=False, min_ratio=2):
+        self.adaptive = adaptive
+        self.min_ratio = min_ratio
+
+        # Set once the server agreed to compress messages
+        self.negotiated = False
+        self.compress_outgoing = True
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_seconds = 0
+
+    @property
+    def ratio(self):
+        """
+        Raw bytes per compressed byte, or None if nothing was compressed
+        """
+        if not self.compressed_bytes:
+            return None
+        return self.raw_bytes / self.compressed_bytes
+
+    @property
+    def disabled_adaptively(self):
+        return self.adaptive and not self.compress_outgoing
+
+    def add(self, raw_bytes, compressed_bytes, cpu_seconds):
+        self.raw_bytes += raw_bytes
+        self.compressed_bytes += compressed_bytes
+        self.cpu_seconds += cpu_seconds
+        if not self.adaptive or not self.compress_outgoing:
+            return
+        if self.raw_bytes >= self.sample_bytes and self.ratio < self.min_ratio:
+            self.compress_outgoing = False
+
+
+class MeasuredPerMessageDeflate(Extension):
+    """
+    Wraps a negotiated per-message deflate extension, keeping track of its
+    CompressionStats
+    """
+
+    def __init__(self, extension, stats):
+        self.extension = extension
+        self.stats = stats
+
+    @property
+    def name(self):
+        return self.extension.name
+
+    def decode(self, frame, *, max_size=None):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        start = time.thread_time()
+        decoded = self.extension.decode(frame, max_size=max_size)
+        if decoded is frame:
+            # Not compressed
+            self.stats.add(len(frame.data), len(frame.data), 0)
+        else:
+            self.stats.add(
+                len(decoded.data), len(frame.data), time.thread_time() - start
+            )
+        return decoded
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        if not self.stats.compress_outgoing:
+            # Messages may be sent uncompressed, by leaving rsv1 unset
+            self.stats.add(len(frame.data), len(frame.data), 0)
+            return frame
+        start = time.thread_time()
+        encoded = self.extension.encode(frame)
+        self.stats.add(len(frame.data), len(encoded.data), time.thread_time() - start)
+        return encoded
+
+
+class MeasuredPerMessageDeflateFactory(ClientPerMessageDeflateFactory):
+    """
+    Negotiates per-message deflate, measuring it with stats once agreed on
+    """
+
+    def __init__(self, *args, stats, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+
+    def process_response_params(self, params, accepted_extensions):
+        extension = super().process_response_params(params, accepted_extensions)
+        self.stats.negotiated = True
+        return MeasuredPerMessageDeflate(extension, self.stats)
+
+
+def deflate_extension(window_bits, mem_level, stats):
+    """
+    Return a websocket extension factory offering per-message deflate
+
+    Up to window_bits of history are used to compress messages in both
+    directions, and compressing uses memory according to mem_level as with
+    zlib.compressobj.
+    """
+    if window_bits < 15:
+        server_max_window_bits = client_max_window_bits = window_bits
+    else:
+        # Asking for the maximum makes servers that don't echo it back in
+        # their response fail the handshake, so leave it to them
+        server_max_window_bits = None
+        client_max_window_bits = True
+    return MeasuredPerMessageDeflateFactory(
+        server_max_window_bits=server_max_window_bits,
+        client_max_window_bits=client_max_window_bits,
+        compress_settings={"memLevel": mem_level},
+        stats=stats,
+    )
@@ -0,0 +1,425 @@
+import asyncio
+import logging
+import re
+import ssl
+import time
+from urllib.parse import unquote
+
+from aiohttp import ClientError
+from yarl import URL
+
+from .metrics import ACTIVE_FORWARDED_CHANNELS
+from .metrics import FORWARDED_CHANNEL_DURATION_SECONDS
+from .metrics import FORWARDED_INPUT_BYTES
+from .metrics import FORWARDED_OUTPUT_BYTES
+from .metrics import FORWARDED_REQUEST_DURATION_SECONDS
+
+# Hosts forwarded to, as jupyter-server-proxy's /proxy/<host>:<port>/ takes
+# them. Anything else could change the path we proxy to.
+VALID_HOST = re.compile(r"[A-Za-z0-9.-]+|\[[0-9A-Fa-f:.]+\]")
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1", "[::1]"}
+# Methods & header names, as RFC 9110 defines tokens
+TOKEN = re.compile(r"[!#$%&'*+.^_`|~0-9A-Za-z-]+")
+# Never valid in a request target or header value, and could split them into
+# more requests or headers further on
+FORBIDDEN_CHARS = re.compile(r"[\x00\r\n]")
+
+# Not forwarded as is in either direction, as they describe a single hop
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+# Set by us for requests to the user's server instead
+REPLACED_HEADERS = {"host", "authorization", "content-length"}
+
+MAX_HEAD_SIZE = 65536
+CHUNK_SIZE = 65536
+
+BAD_GATEWAY = b"HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n"
+
+
+class BadRequest(Exception):
+    pass
+
+
+def proxy_prefix(dest_host, dest_port):
+    """
+    Return path of jupyter-server-proxy's prefix for dest_host & dest_port
+
+    Returns None if dest_host can't be proxied to.
+    """
+    if dest_host in LOCAL_HOSTS:
+        return f"proxy/{dest_port}"
+    if VALID_HOST.fullmatch(dest_host):
+        return f"proxy/{dest_host}:{dest_port}"
+    return None
+
+
+def parse_head(head):
+    """
+    Return method, target, version & headers of a request's head
+    """
+    try:
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, version = lines[0].split(" ")
+        headers = []
+        for line in lines[1:]:
+            if line:
+                name, value = line.split(":", 1)
+                headers.append((name, value.strip(" \t")))
+    except ValueError:
+        raise BadRequest(f"Malformed request {head[:80]!r}") from None
+    if not TOKEN.fullmatch(method) or FORBIDDEN_CHARS.search(target):
+        raise BadRequest(f"Malformed request line {lines[0][:80]!r}")
+    for name, value in headers:
+        if not TOKEN.fullmatch(name) or FORBIDDEN_CHARS.search(value):
+            raise BadRequest(f"Malformed header {name[:80]!r}")
+    if not target.startswith("/") or version not in ("HTTP/1.0", "HTTP/1.1"):
+        raise BadRequest(f"Unsupported request {lines[0][:80]!r}")
+    if has_dot_segments(target):
+        raise BadRequest(f"Request outside of proxied port {lines[0][:80]!r}")
+    return method, target, version, headers
+
+
+def has_dot_segments(target):
+    """
+    Return True if target's path has '.' or '..' segments, even encoded
+
+    Targets are appended to the proxy's prefix as they are, and proxies
+    normalizing the path would take such segments out of the prefix, e.g.
+    to the hub's API or other users' servers.
+    """
+    path = target.split("?", 1)[0]
+    # Decoded until nothing changes, as proxies may decode more than once
+    while True:
+        decoded = unquote(path)
+        if decoded == path:
+            break
+        path = decoded
+    return any(segment in (".", "..") for segment in re.split(r"[/\\]", path))
+
+
+def header_tokens(headers, name):
+    """
+    Return the comma separated, lowercased values of all name headers
+    """
+    return {
+        token.strip().lower()
+        for header, value in headers
+        if header.lower() == name
+        for token in value.split(",")
+    }
+
+
+class ForwardedChannel:
+    """
+    A channel forwarded with `ssh -L` to a port on a user's server
+
+    The only way into users' servers is HTTP through JupyterHub's proxy, so
+    rather than raw TCP, forwarded channels carry HTTP requests to the
+    services people forward ports for (TensorBoard, Dask dashboards...).
+    Each request read from the channel is sent on to the port through
+    jupyter-server-proxy, as /proxy/<port>/ of the user's server, and its
+    response written back.
+
+    Requests go through the app's pool of keep-alive HTTP connections, so
+    all channels of all SSH connections share a few connections to the
+    proxy rather than opening one each. Websocket upgrades are the
+    exception, getting a connection of their own that bytes are relayed
+    over both ways once the request has been sent on.
+
+    Bodies are streamed in both directions, reading from one side only as
+    fast as the other takes them, so SSH's per-channel window bounds what
+    we buffer for each channel.
+    """
+
+    __slots__ = (
+        "http_client",
+        "notebook_url",
+        "token",
+        "dest_host",
+        "dest_port",
+        "requests",
+        "span",
+        "log",
+        "prefix",
+        "input_bytes",
+        "output_bytes",
+        "body_read",
+    )
+
+    def __init__(
+        self,
+        http_client,
+        notebook_url,
+        token,
+        dest_host,
+        dest_port,
+        requests,
+        span,
+        log=None,
+    ):
+        self.http_client = http_client
+        self.notebook_url = notebook_url
+        self.token = token
+        self.dest_host = dest_host
+        self.dest_port = dest_port
+        # Semaphore limiting requests in flight, shared with the other
+        # channels of the same SSH connection
+        self.requests = requests
+        self.span = span
+        self.log = log or logging.getLogger(__name__)
+
+        self.prefix = proxy_prefix(dest_host, dest_port)
+        self.input_bytes = 0
+        self.output_bytes = 0
+        # Whether the body of the request being forwarded was read in full
+        self.body_read = True
+
+    async def __call__(self, reader, writer):
+        """
+        Forward requests read from the channel until either side is done
+        """
+        start = time.perf_counter()
+        ACTIVE_FORWARDED_CHANNELS.inc()
+        try:
+            while await self.forward_request(reader, writer):
+                pass
+        except BadRequest as e:
+            self.log.debug("Closing forwarded channel: %s", e)
+            self.write(writer, b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            self.span.set(error=repr(e))
+            self.log.warning(
+                "Failed to forward to port %i: %r", self.dest_port, e, exc_info=True
+            )
+        finally:
+            ACTIVE_FORWARDED_CHANNELS.dec()
+            duration = time.perf_counter() - start
+            FORWARDED_CHANNEL_DURATION_SECONDS.observe(duration)
+            self.span.end(input_bytes=self.input_bytes, output_bytes=self.output_bytes)
+            self.log.debug(
+                "Forwarded channel to port %i closed after %.1fs, "
+                "%i bytes in & %i bytes out",
+                self.dest_port,
+                duration,
+                self.input_bytes,
+                self.output_bytes,
+            )
+            writer.close()
+
+    def write(self, writer, data):
+        self.output_bytes += len(data)
+        FORWARDED_OUTPUT_BYTES.inc(len(data))
+        writer.write(data)
+
+    def count_input(self, data):
+        self.input_bytes += len(data)
+        FORWARDED_INPUT_BYTES.inc(len(data))
+        return data
+
+    async def read_head(self, reader):
+        """
+        Return the head of the next request, or None once the channel ends
+        """
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise BadRequest("Channel ended mid request") from None
+            return None
+        if len(head) > MAX_HEAD_SIZE:
+            raise BadRequest("Request head too large")
+        return self.count_input(head)
+
+    async def read_body(self, reader, headers):
+        """
+        Yield chunks of a request's body as read from the channel
+        """
+        if "chunked" in header_tokens(headers, "transfer-encoding"):
+            while True:
+                size_line = self.count_input(await reader.readuntil(b"\r\n"))
+                try:
+                    size = int(size_line.split(b";", 1)[0], 16)
+                except ValueError:
+                    raise BadRequest("Malformed chunk size") from None
+                if size == 0:
+                    # Skip trailers
+                    while self.count_input(await reader.readuntil(b"\r\n")) != b"\r\n":
+                        pass
+                    break
+                while size > 0:
+                    chunk = self.count_input(await reader.read(min(size, CHUNK_SIZE)))
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b"", size)
+                    size -= len(chunk)
+                    yield chunk
+                self.count_input(await reader.readexactly(2))
+        else:
+            lengths = {
+                value for name, value in headers if name.lower() == "content-length"
+            }
+            if len(lengths) > 1 or not all(length.isdigit() for length in lengths):
+                raise BadRequest("Invalid Content-Length")
+            remaining = int(lengths.pop()) if lengths else 0
+            while remaining > 0:
+                chunk = self.count_input(await reader.read(min(remaining, CHUNK_SIZE)))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(chunk)
+                yield chunk
+        self.body_read = True
+
+    async def forward_request(self, reader, writer):
+        """
+        Forward one request & its response, returning True to keep going
+        """
+        head = await self.read_head(reader)
+        if head is None:
+            return False
+        method, target, version, headers = parse_head(head)
+        url = URL(
+            f"{str(self.notebook_url).rstrip('/')}/{self.prefix}{target}", encoded=True
+        )
+
+        connection = header_tokens(headers, "connection")
+        if "upgrade" in connection:
+            await self.relay_upgrade(reader, writer, method, url, headers)
+            return False
+        if version == "HTTP/1.1":
+            keep_alive = "close" not in connection
+        else:
+            keep_alive = "keep-alive" in connection
+
+        upstream_headers = [
+            (name, value)
+            for name, value in headers
+            if name.lower() not in HOP_BY_HOP_HEADERS | REPLACED_HEADERS
+        ]
+        upstream_headers.append(("Authorization", f"token {self.token}"))
+        body = None
+        if header_tokens(headers, "transfer-encoding") or any(
+            name.lower() == "content-length" for name, _ in headers
+        ):
+            self.body_read = False
+            body = self.read_body(reader, headers)
+
+        start = time.perf_counter()
+        async with self.requests:
+            try:
+                resp = await self.http_client.request(
+                    method,
+                    url,
+                    headers=upstream_headers,
+                    data=body,
+                    allow_redirects=False,
+                    skip_auto_headers=("Accept", "Accept-Encoding", "User-Agent"),
+                )
+            except ClientError as e:
+                FORWARDED_REQUEST_DURATION_SECONDS.labels(status="error").observe(
+                    time.perf_counter() - start
+                )
+                self.log.debug("Failed to forward request to %s: %r", url, e)
+                self.write(writer, BAD_GATEWAY)
+                return False
+            async with resp:
+                FORWARDED_REQUEST_DURATION_SECONDS.labels(
+                    status=str(resp.status)
+                ).observe(time.perf_counter() - start)
+                # Whatever is left of a body the server didn't wait for
+                # would be read as the next request
+                keep_alive = keep_alive and self.body_read
+                return await self.write_response(
+                    writer, method, version, resp, keep_alive
+                )
+
+    async def write_response(self, writer, method, version, resp, keep_alive):
+        """
+        Write resp back to the channel, returning True if it can be reused
+        """
+        lines = [f"{version} {resp.status} {resp.reason}".encode("latin-1")]
+        headers = [
+            (name, value)
+            for name, value in resp.raw_headers
+            if name.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS
+        ]
+        has_body = method != "HEAD" and resp.status not in (204, 304)
+        chunked = False
+        if has_body and resp.content_length is None:
+            if version == "HTTP/1.1":
+                chunked = True
+                headers.append((b"Transfer-Encoding", b"chunked"))
+            else:
+                # The end of the body is where the channel closes
+                keep_alive = False
+        headers.append((b"Connection", b"keep-alive" if keep_alive else b"close"))
+        lines.extend(name + b": " + value for name, value in headers)
+        self.write(writer, b"\r\n".join(lines) + b"\r\n\r\n")
+
+        if has_body:
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                if chunked:
+                    chunk = b"%x\r\n%s\r\n" % (len(chunk), chunk)
+                self.write(writer, chunk)
+                await writer.drain()
+            if chunked:
+                self.write(writer, b"0\r\n\r\n")
+        await writer.drain()
+        return keep_alive
+
+    async def relay_upgrade(self, reader, writer, method, url, headers):
+        """
+        Send an upgrade request on over a connection of its own, then relay
+        bytes both ways until either side closes
+
+        Only connecting counts against the forwarded requests at once, as
+        websockets stay open for long and would otherwise take up every slot.
+        """
+        secure = url.scheme == "https"
+        async with self.requests:
+            upstream_reader, upstream_writer = await asyncio.open_connection(
+                url.host,
+                url.port,
+                ssl=ssl.create_default_context() if secure else None,
+            )
+        lines = [
+            f"{method} {url.raw_path_qs} HTTP/1.1",
+            f"Host: {url.raw_host}" + ("" if url.is_default_port() else f":{url.port}"),
+            f"Authorization: token {self.token}",
+        ]
+        lines.extend(
+            f"{name}: {value}"
+            for name, value in headers
+            if name.lower() not in REPLACED_HEADERS
+        )
+        upstream_writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        try:
+            await asyncio.gather(
+                self.pipe(reader, upstream_writer, self.count_input),
+                self.pipe(upstream_reader, writer, None),
+            )
+        finally:
+            upstream_writer.close()
+
+    async def pipe(self, reader, writer, count_input):
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            if count_input is not None:
+                count_input(data)
+                writer.write(data)
+            else:
+                self.write(writer, data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
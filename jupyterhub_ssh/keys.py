@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+
+import asyncssh
+
+from .cache import TTLCache
+
+
+def authorized_fingerprints(text, log=None):
+    """
+    Return SHA256 fingerprints of the keys in an authorized_keys file
+
+    Keys with options (like from= or command=) are skipped, as we couldn't
+    honor the restrictions they place on logins with them.
+    """
+    log = log or logging.getLogger(__name__)
+    fingerprints = set()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            key = asyncssh.import_public_key(line)
+        except asyncssh.KeyImportError:
+            log.debug("Skipping authorized key with options or of unknown type")
+            continue
+        fingerprints.add(key.get_fingerprint("sha256"))
+    return fingerprints
+
+
+class AuthorizedKeysIndex:
+    """
+    Users' authorized SSH public keys, by fingerprint
+
+    fetch(username) is a coroutine returning the URL of the user's server
+    and the text of their authorized_keys file, or None if they have no
+    server running to read it from.
+
+    Keys are remembered for ttl seconds after being fetched, and fetched
+    again in the background when looked up during the second half of that,
+    so users logging in regularly don't wait for keys to be fetched. At
+    most max_size users' keys are remembered.
+    """
+
+    def __init__(self, fetch, ttl, max_size, log=None):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.log = log or logging.getLogger(__name__)
+
+        # (time fetched, server URL, fingerprints) by username
+        self._entries = TTLCache(ttl, max_size)
+        # Fetches in progress by username, shared by concurrent lookups
+        self._fetches = {}
+
+    async def lookup(self, username, fingerprint):
+        """
+        Return URL of username's server if fingerprint is an authorized key
+        of theirs, and whether it was looked up without fetching keys
+
+        The URL is None if the key isn't authorized, or can't be checked.
+        """
+        entry = self._entries.get(username)
+        cached = entry is not None
+        if entry is None:
+            entry = await self._fetch(username)
+            if entry is None:
+                return None, cached
+        elif entry[0] < time.monotonic() - self.ttl / 2:
+            self._fetch(username)
+
+        _, notebook_url, fingerprints = entry
+        if fingerprint not in fingerprints:
+            return None, cached
+        return notebook_url, cached
+
+    def invalidate(self, username):
+        """
+        Forget username's keys, e.g. when their server went away
+        """
+        self._entries.invalidate(username)
+
+    def _fetch(self, username):
+        """
+        Return a future fetching username's keys, starting it if needed
+        """
+        fetch = self._fetches.get(username)
+        if fetch is None:
+            fetch = asyncio.ensure_future(self._do_fetch(username))
+            self._fetches[username] = fetch
+            fetch.add_done_callback(lambda _: self._fetches.pop(username, None))
+        return fetch
+
+    async def _do_fetch(self, username):
+        try:
+            fetched = await self.fetch(username)
+        except Exception as e:
+            self.log.warning("Failed to fetch authorized keys of %s: %r", username, e)
+            return None
+        if fetched is None:
+            # Keys may be added once a server is running, so don't remember
+            self._entries.invalidate(username)
+            return None
+        notebook_url, text = fetched
+        entry = (
+            time.monotonic(),
+            notebook_url,
+            authorized_fingerprints(text, self.log),
+        )
+        self._entries.set(username, entry)
+        return entry
@@ -0,0 +1,156 @@
+import os
+
+from prometheus_client import CollectorRegistry
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client import multiprocess
+from prometheus_client import REGISTRY
+from prometheus_client import start_http_server
+
+AUTH_DURATION_SECONDS = Histogram(
+    "jupyterhub_ssh_auth_duration_seconds",
+    "Time taken to authenticate a login, including starting the user's server",
+    ["status"],
+)
+
+HUB_API_DURATION_SECONDS = Histogram(
+    "jupyterhub_ssh_hub_api_duration_seconds",
+    "Time taken for JupyterHub's REST API to respond",
+    ["request", "status"],
+)
+
+SPAWN_WAIT_DURATION_SECONDS = Histogram(
+    "jupyterhub_ssh_spawn_wait_duration_seconds",
+    "Time spent waiting for a pending user server to start",
+    ["status"],
+    buckets=[1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600],
+)
+
+TERMINAL_CREATE_DURATION_SECONDS = Histogram(
+    "jupyterhub_ssh_terminal_create_duration_seconds",
+    "Time taken to create a terminal on a user server",
+)
+
+WEBSOCKET_CONNECT_DURATION_SECONDS = Histogram(
+    "jupyterhub_ssh_websocket_connect_duration_seconds",
+    "Time taken to connect to a terminal's websocket",
+)
+
+RELAYED_BYTES = Counter(
+    "jupyterhub_ssh_relayed_bytes",
+    "Data relayed between SSH sessions and terminals",
+    ["direction"],
+)
+
+RELAYED_FRAMES = Counter(
+    "jupyterhub_ssh_relayed_frames",
+    "Websocket messages relayed between SSH sessions and terminals",
+    ["direction"],
+)
+
+WEBSOCKET_COMPRESSION_RATIO = Histogram(
+    "jupyterhub_ssh_websocket_compression_ratio",
+    "Factor by which sessions' websocket messages shrank when compressed",
+    buckets=[1, 1.25, 1.5, 2, 3, 4, 6, 8, 12, 16, 32],
+)
+
+WEBSOCKET_COMPRESSION_CPU_SECONDS = Counter(
+    "jupyterhub_ssh_websocket_compression_cpu_seconds",
+    "CPU time spent compressing and decompressing websocket messages",
+)
+
+ACTIVE_CONNECTIONS = Gauge(
+    "jupyterhub_ssh_active_connections",
+    "Number of open SSH connections",
+    multiprocess_mode="livesum",
+)
+
+ACTIVE_SESSIONS = Gauge(
+    "jupyterhub_ssh_active_sessions",
+    "Number of SSH sessions connected to a terminal",
+    multiprocess_mode="livesum",
+)
+
+FORWARDED_BYTES = Counter(
+    "jupyterhub_ssh_forwarded_bytes",
+    "Data relayed over channels forwarded to users' servers",
+    ["direction"],
+)
+
+FORWARDED_REQUEST_DURATION_SECONDS = Histogram(
+    "jupyterhub_ssh_forwarded_request_duration_seconds",
+    "Time taken for a request forwarded to a user's server to get a response",
+    ["status"],
+)
+
+FORWARDED_CHANNEL_DURATION_SECONDS = Histogram(
+    "jupyterhub_ssh_forwarded_channel_duration_seconds",
+    "How long channels forwarded to users' servers stayed open",
+    buckets=[0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600],
+)
+
+ACTIVE_FORWARDED_CHANNELS = Gauge(
+    "jupyterhub_ssh_active_forwarded_channels",
+    "Number of open channels forwarded to users' servers",
+    multiprocess_mode="livesum",
+)
+
+DETACHED_SESSIONS = Gauge(
+    "jupyterhub_ssh_detached_sessions",
+    "Number of terminals kept running for sessions to reattach to",
+    multiprocess_mode="livesum",
+)
+
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "jupyterhub_ssh_event_loop_lag_seconds",
+    "How late the event loop ran a callback scheduled for a given time",
+    buckets=[0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5],
+)
+
+# Labelled once up front, as these are updated for every message relayed.
+# 'input' is from SSH to terminado or a user's server, 'output' back to SSH.
+INPUT_BYTES = RELAYED_BYTES.labels(direction="input")
+INPUT_FRAMES = RELAYED_FRAMES.labels(direction="input")
+OUTPUT_BYTES = RELAYED_BYTES.labels(direction="output")
+OUTPUT_FRAMES = RELAYED_FRAMES.labels(direction="output")
+FORWARDED_INPUT_BYTES = FORWARDED_BYTES.labels(direction="input")
+FORWARDED_OUTPUT_BYTES = FORWARDED_BYTES.labels(direction="output")
+
+
+def multiprocess_enabled():
+    """
+    True if metrics are kept in files shared by all worker processes
+    """
+    return "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+
+def start_metrics_server(port, ip=""):
+    """
+    Serve metrics over HTTP from a background thread
+
+    In multiprocess mode, the metrics of all workers are combined.
+    """
+    registry = REGISTRY
+    if multiprocess_enabled():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, ip or "0.0.0.0", registry=registry)
+
+
+def clear_multiprocess_dir():
+    """
+    Remove metrics left behind by workers of a previous run
+    """
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
+
+
+def mark_worker_dead(pid):
+    """
+    Stop counting a worker that has exited towards live gauges
+    """
+    if multiprocess_enabled():
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+
+class TerminalPool:
+    """
+    Spare terminals, created & connected ahead of time for new sessions
+
+    Creating a terminal, connecting to it and waiting for its shell to start
+    takes long enough for users to notice. By keeping spare terminals around
+    for users who recently logged in, new sessions can start right away.
+
+    Spares are kept per user & notebook server. At most size spares are kept
+    for each, and spares unused for idle_timeout seconds are closed.
+    """
+
+    def __init__(self, size, idle_timeout, log=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.log = log or logging.getLogger(__name__)
+
+        # (Terminado, task starting it) pairs, started or not, by key
+        self._spares = defaultdict(list)
+        # Timers closing spare terminals nobody used, by Terminado
+        self._expiry_handles = {}
+
+    def fill(self, key, create_terminado, start_terminado):
+        """
+        Start creating spare terminals for key, up to our size
+
+        create_terminado is called to get each (not yet started) Terminado,
+        and start_terminado with it to start it.
+        """
+        spares = self._spares[key]
+        while len(spares) < self.size:
+            terminado = create_terminado()
+            spare = (terminado, asyncio.ensure_future(start_terminado(terminado)))
+            spare[1].add_done_callback(
+                lambda _, spare=spare: self._spare_ready(key, spare)
+            )
+            spares.append(spare)
+
+    async def acquire(self, key):
+        """
+        Take a spare terminal for key, or return None if there is none
+
+        Terminals still being created are waited for, as that's still quicker
+        than creating one from scratch.
+        """
+        spares = self._spares.get(key)
+        while spares:
+            terminado, started = spares.pop(0)
+            handle = self._expiry_handles.pop(terminado, None)
+            if handle is not None:
+                handle.cancel()
+            try:
+                await started
+            except Exception:
+                continue
+            if not terminado.closed:
+                return terminado
+        self._spares.pop(key, None)
+        return None
+
+    async def close(self):
+        """
+        Close all spare terminals
+        """
+        spares = [spare for spares in self._spares.values() for spare in spares]
+        self._spares.clear()
+        for handle in self._expiry_handles.values():
+            handle.cancel()
+        self._expiry_handles.clear()
+        await asyncio.gather(
+            *(self._close_spare(spare) for spare in spares), return_exceptions=True
+        )
+
+    def _spare_ready(self, key, spare):
+        terminado, started = spare
+        if started.cancelled() or spare not in self._spares.get(key, ()):
+            # Already taken or dropped
+            return
+        if started.exception() is not None:
+            self.log.warning(
+                "Failed to create spare terminal for %s: %r",
+                key[0],
+                started.exception(),
+            )
+            self._drop(key, spare)
+            return
+        loop = asyncio.get_running_loop()
+        self._expiry_handles[terminado] = loop.call_later(
+            self.idle_timeout, self._expire, key, spare
+        )
+
+    def _expire(self, key, spare):
+        self._expiry_handles.pop(spare[0], None)
+        self._drop(key, spare)
+        asyncio.ensure_future(self._close_spare(spare))
+
+    def _drop(self, key, spare):
+        spares = self._spares.get(key)
+        if spares and spare in spares:
+            spares.remove(spare)
+            if not spares:
+                del self._spares[key]
+
+    async def _close_spare(self, spare):
+        terminado, started = spare
+        try:
+            await started
+            await terminado.close()
+        except Exception as e:
+            self.log.warning("Failed to close spare terminal: %r", e)
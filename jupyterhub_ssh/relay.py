@@ -0,0 +1,228 @@
+import asyncio
+import codecs
+import time
+
+import asyncssh
+
+from .metrics import INPUT_BYTES
+from .metrics import INPUT_FRAMES
+from .metrics import OUTPUT_BYTES
+
+
+class OutputBatcher:
+    """
+    Coalesce output from terminado into fewer, larger writes to SSH stdout
+
+    Programs producing lots of output make terminado send many tiny
+    messages. Writing each of them to the SSH channel on its own costs an SSH
+    packet, a syscall and a drain per message, so instead consecutive
+    messages are merged until either flush_bytes of output are pending or
+    flush_delay seconds have passed since the first of them arrived.
+
+    We only wait for the SSH channel to drain once more than high_water
+    bytes are waiting to be sent on it.
+
+    stdout is expected to take bytes. Output is UTF-8 encoded once per
+    write to it, rather than per message.
+
+    first_write_span, if given, is ended once output is first written.
+    Output written is also kept in scrollback, if given.
+    """
+
+    __slots__ = (
+        "stdout",
+        "flush_bytes",
+        "flush_delay",
+        "high_water",
+        "first_write_span",
+        "scrollback",
+        "last_activity",
+        "_buffer",
+        "_buffer_size",
+        "_flush_handle",
+    )
+
+    def __init__(
+        self,
+        stdout,
+        flush_bytes,
+        flush_delay,
+        high_water,
+        first_write_span=None,
+        scrollback=None,
+    ):
+        self.stdout = stdout
+        self.flush_bytes = flush_bytes
+        self.flush_delay = flush_delay
+        self.high_water = high_water
+        self.first_write_span = first_write_span
+        self.scrollback = scrollback
+        # time.monotonic() of when output was last written
+        self.last_activity = time.monotonic()
+
+        self._buffer = []
+        self._buffer_size = 0
+        self._flush_handle = None
+
+    async def write(self, data):
+        """
+        Queue data to be written to stdout
+        """
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self.stdout.is_closing():
+            # Only kept in the scrollback now, as nothing drains the channel
+            self.write_buffer()
+            return
+        if self._buffer_size >= self.flush_bytes:
+            self.write_buffer()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.flush_delay, self.write_buffer)
+
+        if self.stdout.channel.get_write_buffer_size() > self.high_water:
+            await self.stdout.drain()
+
+    def write_buffer(self):
+        """
+        Write out everything queued so far, without waiting for it to be sent
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._buffer:
+            # Lone surrogates can come from terminado's JSON, and can't be
+            # encoded
+            data = "".join(self._buffer).encode("utf-8", "replace")
+            self._buffer.clear()
+            self._buffer_size = 0
+            if self.scrollback is not None:
+                self.scrollback.write(data)
+            try:
+                self.stdout.write(data)
+            except ConnectionError:
+                # The client went away, and the session is about to end.
+                # Called from call_later too, so don't raise
+                return
+            OUTPUT_BYTES.inc(len(data))
+            self.last_activity = time.monotonic()
+            if self.first_write_span is not None:
+                self.first_write_span.end()
+                self.first_write_span = None
+
+
+class InputBatcher:
+    """
+    Coalesce SSH stdin into fewer terminado messages, and debounce resizes
+
+    Pasting text or typing quickly gives us many small reads from stdin.
+    Rather than sending a terminado message for each, reads arriving within
+    flush_delay seconds of each other are sent together.
+
+    Dragging a terminal window around makes the SSH client report lots of
+    size changes, but only the last one matters. Once a size change arrives,
+    we wait for resize_delay seconds and only send the latest size then.
+
+    Once buffer_limit bytes of input are waiting to be sent, we stop reading
+    from stdin until they have been, so SSH flow control slows down the
+    client rather than input piling up in memory.
+
+    stdin is expected to give bytes, which are decoded as UTF-8 as they are
+    sent. Characters split between reads are decoded once complete, and
+    invalid bytes are replaced.
+    """
+
+    __slots__ = (
+        "terminado",
+        "flush_delay",
+        "resize_delay",
+        "buffer_limit",
+        "last_activity",
+        "_buffer",
+        "_buffer_size",
+        "_decoder",
+        "_drained",
+        "_size",
+        "_eof",
+        "_wakeup",
+    )
+
+    def __init__(self, terminado, flush_delay, resize_delay, buffer_limit):
+        self.terminado = terminado
+        self.flush_delay = flush_delay
+        self.resize_delay = resize_delay
+        self.buffer_limit = buffer_limit
+        # time.monotonic() of when input was last sent
+        self.last_activity = time.monotonic()
+
+        self._buffer = []
+        self._buffer_size = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        # Set whenever the buffer has been emptied
+        self._drained = asyncio.Event()
+        self._size = None
+        self._eof = False
+        self._wakeup = asyncio.Event()
+
+    async def relay(self, stdin):
+        """
+        Relay stdin to terminado until stdin reaches EOF
+        """
+        reader = asyncio.ensure_future(self._read(stdin))
+        try:
+            await self._send()
+        finally:
+            reader.cancel()
+        if not reader.cancelled():
+            # Surface any error that made us stop reading
+            reader.result()
+
+    async def _read(self, stdin):
+        try:
+            while not stdin.at_eof():
+                if self._buffer_size >= self.buffer_limit:
+                    self._drained.clear()
+                    await self._drained.wait()
+                try:
+                    # Return *upto* 4096 bytes from the stdin buffer
+                    # Returns pretty immediately - doesn't *wait* for 4096 bytes
+                    # to be present in the buffer.
+                    data = await stdin.read(4096)
+                    self._buffer.append(data)
+                    self._buffer_size += len(data)
+                except asyncssh.misc.TerminalSizeChanged as e:
+                    self._size = (e.height, e.width)
+                except asyncssh.misc.BreakReceived:
+                    continue
+                self._wakeup.set()
+        finally:
+            self._eof = True
+            self._wakeup.set()
+
+    async def _send(self):
+        while True:
+            await self._wakeup.wait()
+            # Give more input or size changes a chance to arrive, so we can
+            # send them along in one go
+            if self._buffer:
+                await asyncio.sleep(self.flush_delay)
+            elif self._size is not None and not self._eof:
+                await asyncio.sleep(self.resize_delay)
+            self._wakeup.clear()
+
+            if self._size is not None:
+                size, self._size = self._size, None
+                await self.terminado.set_size(*size)
+            if self._buffer:
+                data = b"".join(self._buffer)
+                self._buffer.clear()
+                self._buffer_size = 0
+                self._drained.set()
+                INPUT_BYTES.inc(len(data))
+                self.last_activity = time.monotonic()
+                text = self._decoder.decode(data, final=self._eof)
+                if text:
+                    await self.terminado.send_stdin(text)
+                    INPUT_FRAMES.inc()
+            if self._eof and not self._buffer:
+                return
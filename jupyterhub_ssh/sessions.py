@@ -0,0 +1,177 @@
+import asyncio
+import logging
+
+from .metrics import OUTPUT_FRAMES
+
+# Environment variable clients name the session they want to (re)attach to
+# with, e.g. with `ssh -o SetEnv=JUPYTERHUB_SSH_SESSION=work`
+SESSION_ENV = "JUPYTERHUB_SSH_SESSION"
+
+
+class Scrollback:
+    """
+    The last size bytes of a terminal's output, in a fixed-size ring buffer
+
+    The buffer only grows to size bytes as output is written, so sessions
+    that don't output much don't cost much.
+    """
+
+    __slots__ = ("size", "_buffer", "_written")
+
+    def __init__(self, size):
+        self.size = size
+        self._buffer = bytearray()
+        # Bytes ever written, of which we keep the last size
+        self._written = 0
+
+    def write(self, data):
+        if not self.size or not data:
+            return
+        free = self.size - len(self._buffer)
+        if free > 0:
+            # Still filling the buffer up, before wrapping around
+            self._buffer += data[:free]
+            self._written += min(free, len(data))
+            data = data[free:]
+            if not data:
+                return
+        self._written += len(data)
+        data = memoryview(data)[-self.size :]
+        end = self._written % self.size
+        start = (end - len(data)) % self.size
+        if start < end:
+            self._buffer[start:end] = data
+        else:
+            # Wraps around the end of the buffer
+            split = self.size - start
+            self._buffer[start:] = data[:split]
+            self._buffer[:end] = data[split:]
+
+    def getvalue(self):
+        """
+        Return what we kept of the output, oldest first
+        """
+        if self._written <= self.size:
+            data = bytes(self._buffer[: self._written])
+        else:
+            end = self._written % self.size
+            data = bytes(self._buffer[end:] + self._buffer[:end])
+            # Don't start with the remains of a partly dropped character
+            data = data.lstrip(bytes(range(0x80, 0xC0)))
+        return data
+
+
+class TerminalSession:
+    """
+    A terminal and its output, which may outlive the SSH sessions using it
+
+    Output is received from terminado for as long as the terminal lives. It
+    is passed on to the attached SSH session's OutputBatcher if there is
+    one, and kept in a Scrollback of scrollback_size bytes, to be replayed
+    to sessions attaching to it later on.
+
+    At most one SSH session is attached at a time. A session attaching takes
+    the terminal over from the one attached before it, if any.
+    """
+
+    __slots__ = (
+        "terminado",
+        "scrollback",
+        "log",
+        "received",
+        "_output",
+        "_attachment",
+        "_expiry_handle",
+    )
+
+    def __init__(self, terminado, scrollback_size=0, log=None):
+        self.terminado = terminado
+        self.scrollback = Scrollback(scrollback_size)
+        self.log = log or logging.getLogger(__name__)
+
+        self._output = None
+        # Done once the attached session should stop relaying, with the
+        # reason why
+        self._attachment = None
+        self._expiry_handle = None
+        # Done once the terminal's websocket has closed
+        self.received = asyncio.ensure_future(
+            terminado.on_receive(self._handle_ws_recv)
+        )
+
+    @property
+    def alive(self):
+        return not self.received.done()
+
+    @property
+    def detached(self):
+        return self._attachment is None
+
+    def attach(self, output):
+        """
+        Relay output to output from now on
+
+        Returns a future done once the session should stop relaying, with
+        'ended' if the terminal ended or 'taken_over' if another session
+        attached to it.
+        """
+        self._cancel_expiry()
+        if self._attachment is not None and not self._attachment.done():
+            self._attachment.set_result("taken_over")
+        self._output = output
+        attachment = self._attachment = asyncio.get_running_loop().create_future()
+
+        def ended(_):
+            if not attachment.done():
+                attachment.set_result("ended")
+
+        self.received.add_done_callback(ended)
+        return attachment
+
+    def detach(self, attachment, grace_period, on_expire):
+        """
+        Stop relaying output to the session that got attachment from attach
+
+        Unless attached to again within grace_period seconds, on_expire is
+        called. Does nothing if another session has attached since.
+        """
+        if attachment is not self._attachment:
+            return
+        self._output = None
+        self._attachment = None
+        loop = asyncio.get_running_loop()
+        self._expiry_handle = loop.call_later(grace_period, on_expire)
+
+    def _cancel_expiry(self):
+        if self._expiry_handle is not None:
+            self._expiry_handle.cancel()
+            self._expiry_handle = None
+
+    async def _handle_ws_recv(self, kind, data):
+        """
+        Handle receiving a single data message from terminado.
+        """
+        if kind == "setup":
+            # Signals we can get going now!
+            return
+        elif kind == "change":
+            # Sets terminal size, but let's ignore this for now
+            return
+        elif kind == "disconnect":
+            # Not exactly sure what to do here?
+            return
+        elif kind != "stdout":
+            raise ValueError(f"Unknown type {kind} received from terminado")
+        OUTPUT_FRAMES.inc()
+        if self._output is None:
+            # Lone surrogates can come from terminado's JSON, and can't be
+            # encoded
+            self.scrollback.write(data.encode("utf-8", "replace"))
+            return
+        try:
+            # Kept in the scrollback by the OutputBatcher as it is written
+            await self._output.write(data)
+        except Exception as e:
+            # The SSH session went away while we were waiting for it, and
+            # is about to detach
+            self.log.debug("Failed to relay output: %r", e)
@@ -0,0 +1,433 @@
+import base64
+import errno
+import os
+import posixpath
+import stat
+import time
+from datetime import datetime
+
+import asyncssh
+
+
+def parse_timestamp(value):
+    """
+    Return seconds since the epoch for an ISO 8601 timestamp from the Contents API
+    """
+    if not value:
+        return None
+    # Python < 3.11 doesn't understand a 'Z' suffix
+    return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+
+
+def model_to_attrs(model):
+    """
+    Return SFTPAttrs describing a Contents API model
+    """
+    if model["type"] == "directory":
+        permissions = stat.S_IFDIR | 0o755
+    elif model.get("writable", True):
+        permissions = stat.S_IFREG | 0o644
+    else:
+        permissions = stat.S_IFREG | 0o444
+    mtime = parse_timestamp(model.get("last_modified"))
+    return asyncssh.SFTPAttrs(
+        size=model.get("size") or 0,
+        permissions=permissions,
+        atime=mtime,
+        mtime=mtime,
+    )
+
+
+class ContentsSFTPServer(asyncssh.SFTPServer):
+    """
+    SFTP server serving files from a user's server through its Contents API
+
+    Paths are relative to the root of the user's server, which usually is
+    their home directory. As the files are only accessed over HTTP(S), no
+    access to the storage backing users' home directories is needed.
+
+    Uploads are sent in chunks (which needs a contents manager supporting
+    chunked uploads, as jupyter_server's default one does) and downloads are
+    streamed, so large files never have to fit in memory. Metadata is cached
+    for the duration of the session for a short while, so clients listing
+    and stat-ing the same paths over and over don't re-fetch them each time.
+    """
+
+    def __init__(self, chan):
+        super().__init__(chan)
+        ssh_server = chan.get_connection().get_owner()
+        self.app = ssh_server.app
+        self.notebook_url = ssh_server.notebook_url
+        self.headers = ssh_server.auth_headers
+
+        # Contents API models by path, with the time they expire at
+        self._models = {}
+        self._open_files = set()
+
+    def api_path(self, path):
+        """
+        Return the Contents API path for an SFTP path
+        """
+        path = posixpath.normpath(posixpath.join("/", path.decode("utf-8")))
+        # normpath leaves a leading '//' alone
+        return path.lstrip("/")
+
+    def contents_url(self, api_path):
+        return self.notebook_url / "api/contents" / api_path
+
+    def raise_for_status(self, resp, api_path):
+        """
+        Raise the SFTPError matching an unsuccessful Contents API response
+        """
+        if resp.status < 400:
+            return
+        reason = f"{resp.reason}: /{api_path}"
+        if resp.status == 404:
+            raise asyncssh.SFTPNoSuchFile(reason)
+        elif resp.status == 403:
+            raise asyncssh.SFTPPermissionDenied(reason)
+        elif resp.status == 409:
+            raise asyncssh.SFTPFileAlreadyExists(reason)
+        raise asyncssh.SFTPFailure(reason)
+
+    def forget(self, *api_paths):
+        """
+        Drop cached metadata of paths, of anything within them, and of the
+        directories containing them
+        """
+        for api_path in api_paths:
+            self._models.pop(posixpath.dirname(api_path), None)
+            prefix = api_path + "/"
+            for cached_path in list(self._models):
+                if cached_path == api_path or cached_path.startswith(prefix):
+                    del self._models[cached_path]
+
+    async def get_model(self, api_path, content=False):
+        """
+        Return the Contents API model for a path, from cache if possible
+
+        Directory models listing their contents are fetched if content is
+        True, and cached models of the directory's contents are updated.
+        """
+        cached = self._models.get(api_path)
+        if cached is not None:
+            expires_at, model = cached
+            has_content = (
+                model["type"] != "directory" or model.get("content") is not None
+            )
+            if expires_at > time.monotonic() and (has_content or not content):
+                return model
+
+        params = {"content": "1" if content else "0"}
+        if content:
+            # We only want listings of directories, never files' contents
+            params["type"] = "directory"
+        async with self.app.http_client.get(
+            self.contents_url(api_path), params=params, headers=self.headers
+        ) as resp:
+            if resp.status == 400 and content:
+                raise asyncssh.SFTPNotADirectory(f"Not a directory: /{api_path}")
+            self.raise_for_status(resp, api_path)
+            model = await resp.json()
+
+        expires_at = time.monotonic() + self.app.sftp_metadata_cache_ttl
+        self._models[api_path] = (expires_at, model)
+        for child in model.get("content") or ():
+            child.setdefault("content", None)
+            self._models.setdefault(child["path"], (expires_at, child))
+        return model
+
+    async def stat(self, path):
+        return model_to_attrs(await self.get_model(self.api_path(path)))
+
+    async def lstat(self, path):
+        # There are no symlinks in the Contents API
+        return await self.stat(path)
+
+    async def fstat(self, file_obj):
+        return await file_obj.stat()
+
+    def setstat(self, path, attrs):
+        # Permissions, ownership and times aren't exposed by the Contents API.
+        # Ignore attempts at setting them, rather than failing transfers of
+        # clients preserving them.
+        pass
+
+    def fsetstat(self, file_obj, attrs):
+        pass
+
+    async def listdir(self, path):
+        api_path = self.api_path(path)
+        model = await self.get_model(api_path, content=True)
+        if model["type"] != "directory":
+            raise asyncssh.SFTPNotADirectory(f"Not a directory: /{api_path}")
+
+        attrs = model_to_attrs(model)
+        parent_attrs = attrs
+        if api_path:
+            parent_attrs = model_to_attrs(
+                await self.get_model(posixpath.dirname(api_path))
+            )
+        names = [
+            asyncssh.SFTPName(b".", attrs=attrs),
+            asyncssh.SFTPName(b"..", attrs=parent_attrs),
+        ]
+        for child in model["content"]:
+            names.append(
+                asyncssh.SFTPName(
+                    child["name"].encode("utf-8"), attrs=model_to_attrs(child)
+                )
+            )
+        return names
+
+    def realpath(self, path):
+        return ("/" + self.api_path(path)).encode("utf-8")
+
+    async def mkdir(self, path, attrs):
+        api_path = self.api_path(path)
+        try:
+            await self.get_model(api_path)
+        except asyncssh.SFTPNoSuchFile:
+            pass
+        else:
+            raise asyncssh.SFTPFileAlreadyExists(f"File exists: /{api_path}")
+
+        self.forget(api_path)
+        async with self.app.http_client.put(
+            self.contents_url(api_path),
+            json={"type": "directory"},
+            headers=self.headers,
+        ) as resp:
+            self.raise_for_status(resp, api_path)
+
+    async def remove(self, path):
+        api_path = self.api_path(path)
+        self.forget(api_path)
+        async with self.app.http_client.delete(
+            self.contents_url(api_path), headers=self.headers
+        ) as resp:
+            self.raise_for_status(resp, api_path)
+
+    async def rmdir(self, path):
+        # The Contents API refuses to delete directories that aren't empty
+        await self.remove(path)
+
+    async def rename(self, oldpath, newpath):
+        old_api_path = self.api_path(oldpath)
+        new_api_path = self.api_path(newpath)
+        self.forget(old_api_path, new_api_path)
+        async with self.app.http_client.patch(
+            self.contents_url(old_api_path),
+            json={"path": new_api_path},
+            headers=self.headers,
+        ) as resp:
+            self.raise_for_status(resp, old_api_path)
+
+    async def posix_rename(self, oldpath, newpath):
+        # Unlike rename, this replaces newpath if it exists
+        try:
+            await self.remove(newpath)
+        except asyncssh.SFTPNoSuchFile:
+            pass
+        await self.rename(oldpath, newpath)
+
+    async def open(self, path, pflags, attrs):
+        api_path = self.api_path(path)
+        if pflags & asyncssh.FXF_WRITE:
+            if pflags & asyncssh.FXF_READ:
+                raise asyncssh.SFTPOpUnsupported(
+                    "Files can't be read & written at once"
+                )
+            try:
+                model = await self.get_model(api_path)
+            except asyncssh.SFTPNoSuchFile:
+                if not pflags & asyncssh.FXF_CREAT:
+                    raise
+            else:
+                if pflags & asyncssh.FXF_EXCL:
+                    raise asyncssh.SFTPFileAlreadyExists(f"File exists: /{api_path}")
+                if model["type"] == "directory":
+                    raise asyncssh.SFTPFailure(f"Is a directory: /{api_path}")
+                if not pflags & asyncssh.FXF_TRUNC and model.get("size"):
+                    # We can only write whole files
+                    raise asyncssh.SFTPOpUnsupported(
+                        "Existing files can only be overwritten"
+                    )
+            file_obj = UploadFile(self, api_path)
+        else:
+            model = await self.get_model(api_path)
+            if model["type"] == "directory":
+                raise asyncssh.SFTPFailure(f"Is a directory: /{api_path}")
+            file_obj = DownloadFile(self, api_path, model.get("size") or 0)
+        self._open_files.add(file_obj)
+        return file_obj
+
+    async def read(self, file_obj, offset, size):
+        return await file_obj.read(offset, size)
+
+    async def write(self, file_obj, offset, data):
+        return await file_obj.write(offset, data)
+
+    async def close(self, file_obj):
+        self._open_files.discard(file_obj)
+        await file_obj.close()
+
+    async def exit(self):
+        # Files still open when the session ends weren't transferred fully
+        for file_obj in self._open_files:
+            await file_obj.abort()
+        self._open_files.clear()
+
+
+class DownloadFile:
+    """
+    A file opened for reading, streamed from the user's server
+
+    Reads are served from a single streaming response for as long as they
+    are sequential, which they are for regular downloads. Reading from
+    anywhere else starts a new response from that offset.
+    """
+
+    def __init__(self, sftp, api_path, size):
+        self.sftp = sftp
+        self.api_path = api_path
+        self.size = size
+        self._resp = None
+        self._position = 0
+
+    def seek(self, offset, whence):
+        """
+        Answer AsyncSSH's queries for the ranges of the file holding data
+
+        Sparse files aren't exposed through the Contents API, so all of the
+        file holds data.
+        """
+        if whence == os.SEEK_DATA:
+            if offset >= self.size:
+                raise OSError(errno.ENXIO, "No data past the end of the file")
+            return offset
+        elif whence == os.SEEK_HOLE:
+            return self.size
+        raise OSError(errno.EINVAL, "Only SEEK_DATA and SEEK_HOLE are supported")
+
+    async def stat(self):
+        return model_to_attrs(await self.sftp.get_model(self.api_path))
+
+    async def _open(self, offset):
+        await self.close()
+        headers = dict(self.sftp.headers)
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        resp = await self.sftp.app.http_client.get(
+            self.sftp.notebook_url / "files" / self.api_path, headers=headers
+        )
+        if resp.status == 416:
+            # Reading past the end of the file
+            resp.release()
+            return
+        try:
+            self.sftp.raise_for_status(resp, self.api_path)
+            if offset and resp.status != 206:
+                # The server doesn't support ranges, skip to offset ourselves
+                remaining = offset
+                while remaining > 0:
+                    skipped = await resp.content.read(min(remaining, 65536))
+                    if not skipped:
+                        break
+                    remaining -= len(skipped)
+        except BaseException:
+            resp.release()
+            raise
+        self._resp = resp
+        self._position = offset
+
+    async def read(self, offset, size):
+        if self._resp is None or offset != self._position:
+            await self._open(offset)
+            if self._resp is None:
+                return b""
+
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = await self._resp.content.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        data = b"".join(chunks)
+        self._position += len(data)
+        return data
+
+    async def close(self):
+        if self._resp is not None:
+            self._resp.release()
+            self._resp = None
+
+    async def abort(self):
+        await self.close()
+
+
+class UploadFile:
+    """
+    A file opened for writing, uploaded to the user's server in chunks
+
+    Writes must be sequential. Once enough has been written, it is sent off
+    as the next chunk of the Contents API's chunked upload mode, so at most
+    a chunk's worth of data is held in memory.
+    """
+
+    def __init__(self, sftp, api_path):
+        self.sftp = sftp
+        self.api_path = api_path
+        self._buffer = bytearray()
+        self._position = 0
+        # Number of the last chunk sent, 0 if none has been
+        self._chunk = 0
+
+    async def stat(self):
+        return asyncssh.SFTPAttrs(size=self._position, permissions=stat.S_IFREG | 0o644)
+
+    async def write(self, offset, data):
+        if offset != self._position:
+            raise asyncssh.SFTPOpUnsupported("Files can only be written sequentially")
+        self._buffer += data
+        self._position += len(data)
+
+        chunk_size = self.sftp.app.sftp_upload_chunk_size
+        while len(self._buffer) >= chunk_size:
+            await self._save(self._buffer[:chunk_size], self._chunk + 1)
+            del self._buffer[:chunk_size]
+        return len(data)
+
+    async def close(self):
+        if self._buffer is None:
+            return
+        if self._chunk == 0:
+            # Everything fit in a single chunk, so save the file in one go
+            await self._save(self._buffer, None)
+        else:
+            # Chunk -1 marks the last chunk of an upload
+            await self._save(self._buffer, -1)
+        self._buffer = None
+
+    async def abort(self):
+        # Whatever chunks were sent are already saved, but don't finish the
+        # upload as if it was complete
+        self._buffer = None
+
+    async def _save(self, data, chunk):
+        model = {
+            "type": "file",
+            "format": "base64",
+            "content": base64.b64encode(data).decode("ascii"),
+        }
+        if chunk is not None:
+            model["chunk"] = chunk
+        self.sftp.forget(self.api_path)
+        async with self.sftp.app.http_client.put(
+            self.sftp.contents_url(self.api_path), json=model, headers=self.sftp.headers
+        ) as resp:
+            self.sftp.raise_for_status(resp, self.api_path)
+        if chunk is not None:
+            self._chunk = chunk
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from aiohttp import ClientResponseError
+
+
+class TerminalSweeper:
+    """
+    Delete terminals we created that no session uses anymore
+
+    Sessions delete their terminal when they end, but that can fail or be
+    cut short, leaving a shell running on the user's server. Every interval
+    seconds, terminals whose websocket has closed but that weren't deleted
+    are looked up on their notebook server with the terminals API, and
+    deleted if they are still there.
+
+    Only terminals we created are ever deleted, never ones the user opened
+    some other way.
+    """
+
+    def __init__(self, interval, log=None):
+        self.interval = interval
+        self.log = log or logging.getLogger(__name__)
+
+        self._terminados = set()
+
+    def track(self, terminado):
+        """
+        Start keeping track of a terminal, once it has been created
+        """
+        if self.interval > 0:
+            self._terminados.add(terminado)
+
+    async def run(self):
+        """
+        Sweep every interval seconds, forever
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                self.log.exception("Failed to sweep orphaned terminals")
+
+    async def sweep(self):
+        """
+        Delete orphaned terminals, and forget about deleted ones
+        """
+        self._terminados = {t for t in self._terminados if not t.deleted}
+        orphans = defaultdict(list)
+        for terminado in self._terminados:
+            # Not connected to, or no longer
+            if terminado.ws is None or terminado.closed:
+                key = (str(terminado.notebook_url), terminado.token)
+                orphans[key].append(terminado)
+        for terminados in orphans.values():
+            await self._sweep_server(terminados)
+
+    async def _sweep_server(self, terminados):
+        try:
+            names = await terminados[0].list_terminals()
+        except Exception as e:
+            if isinstance(e, ClientResponseError) and e.status in (401, 403, 404):
+                # The user's token or server is gone, and its terminals
+                # with it as far as we can tell
+                self._terminados.difference_update(terminados)
+            self.log.warning(
+                "Failed to list terminals on %s: %r", terminados[0].notebook_url, e
+            )
+            return
+
+        for terminado in terminados:
+            if terminado.terminal_name not in names:
+                # Gone already, e.g. when its shell exited
+                self._terminados.discard(terminado)
+                continue
+            try:
+                await terminado.delete()
+            except Exception as e:
+                self.log.warning(
+                    "Failed to delete orphaned terminal %s on %s: %r",
+                    terminado.terminal_name,
+                    terminado.notebook_url,
+                    e,
+                )
+            else:
+                self._terminados.discard(terminado)
+                self.log.info(
+                    "Deleted orphaned terminal %s on %s",
+                    terminado.terminal_name,
+                    terminado.notebook_url,
+                )
@@ -1,45 +1,195 @@
 import json
+import time
+from json.decoder import scanstring
+from json.encoder import encode_basestring
 
 import websockets
 
+from .metrics import TERMINAL_CREATE_DURATION_SECONDS
+from .metrics import WEBSOCKET_CONNECT_DURATION_SECONDS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+
+    json_loads = orjson.loads
+else:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+# Messages to and from terminado are JSON encoded lists, with the kind of
+# message as first item. As we send lots of stdin messages and receive even
+# more stdout messages, we avoid building and encoding / decoding lists for
+# them where we can.
+STDIN_PREFIX = '["stdin", '
+SET_SIZE_PREFIX = '["set_size", '
+# terminado encodes messages with json.dumps' default separators
+STDOUT_PREFIX = '["stdout", "'
+
+
+def encode_stdin(data):
+    """
+    Return a terminado message sending data (a string) to the terminal's stdin
+    """
+    return STDIN_PREFIX + encode_basestring(data) + "]"
+
+
+def encode_set_size(rows, cols):
+    """
+    Return a terminado message setting the terminal's size
+    """
+    return f"{SET_SIZE_PREFIX}{int(rows)}, {int(cols)}]"
+
+
+def decode_message(message):
+    """
+    Return kind and payload of a message received from terminado
+    """
+    if message.startswith(STDOUT_PREFIX):
+        # Only decode the payload string, skipping the list around it
+        data, end = scanstring(message, len(STDOUT_PREFIX))
+        if end == len(message) - 1 and message[end] == "]":
+            return "stdout", data
+    kind, data = json_loads(message)
+    return kind, data
+
 
 class Terminado:
-    def __init__(self, notebook_url, token, session):
+    __slots__ = (
+        "notebook_url",
+        "token",
+        "session",
+        "max_size",
+        "max_queue",
+        "read_limit",
+        "write_limit",
+        "compression",
+        "headers",
+        "terminal_name",
+        "ws",
+        "deleted",
+    )
+
+    def __init__(
+        self,
+        notebook_url,
+        token,
+        session,
+        max_size=2**20,
+        max_queue=32,
+        read_limit=2**16,
+        write_limit=2**16,
+        compression=None,
+    ):
         self.notebook_url = notebook_url
         self.token = token
         self.session = session
+        # Bound how much the websocket buffers in each direction. Once
+        # max_queue messages are waiting to be received, it stops reading
+        # from the network, pushing back on terminado. Messages larger than
+        # max_size bytes close the websocket.
+        self.max_size = max_size
+        self.max_queue = max_queue
+        self.read_limit = read_limit
+        self.write_limit = write_limit
+        # Websocket extension factory to compress messages with, if any
+        self.compression = compression
 
         self.headers = {"Authorization": f"token {self.token}"}
 
-    async def __aenter__(self):
+        self.terminal_name = None
+        self.ws = None
+        # Set once the terminal has been deleted from the notebook server
+        self.deleted = False
+
+    async def start(self):
         """
         Create a terminal & connect to it
         """
         notebook_secure = self.notebook_url.scheme == "https"
 
         create_url = self.notebook_url / "api/terminals"
+        start = time.perf_counter()
         async with self.session.post(create_url, headers=self.headers) as resp:
+            resp.raise_for_status()
             data = await resp.json()
         self.terminal_name = data["name"]
+        TERMINAL_CREATE_DURATION_SECONDS.observe(time.perf_counter() - start)
         socket_url = self.notebook_url / "terminals/websocket" / self.terminal_name
         ws_url = socket_url.with_scheme("wss" if notebook_secure else "ws")
 
-        self.ws = await websockets.connect(str(ws_url), extra_headers=self.headers)
-
-        return self
+        start = time.perf_counter()
+        try:
+            self.ws = await websockets.connect(
+                str(ws_url),
+                extra_headers=self.headers,
+                max_size=self.max_size,
+                max_queue=self.max_queue,
+                read_limit=self.read_limit,
+                write_limit=self.write_limit,
+                extensions=[self.compression] if self.compression else None,
+                compression=None,
+                # Nothing is read from the websocket once max_queue messages
+                # are queued, pongs included, so keepalive pings would time
+                # out and close terminals nobody reads (pooled, detached...)
+                ping_interval=None,
+            )
+        except BaseException:
+            # Don't leave the terminal we just created running
+            try:
+                await self.delete()
+            except Exception:
+                pass
+            raise
+        WEBSOCKET_CONNECT_DURATION_SECONDS.observe(time.perf_counter() - start)
 
-    async def __aexit__(self, exc_type, exc, tb):
+    async def close(self):
         """
-        Close the websocket to terminado
+        Close the websocket to terminado & delete the terminal
         """
         await self.ws.close()
+        await self.delete()
 
+    async def delete(self):
+        """
+        Delete the terminal from the notebook server
+        """
         delete_url = self.notebook_url / "api/terminals" / self.terminal_name
         async with self.session.delete(delete_url, headers=self.headers) as resp:
             # If we send EOD on the websocket URL, the terminal is auto closed
             # But we should clean up regardless!
             if resp.status != 204 and resp.status != 404:
                 resp.raise_for_status()
+        self.deleted = True
+
+    async def list_terminals(self):
+        """
+        Return names of all terminals on the notebook server
+        """
+        list_url = self.notebook_url / "api/terminals"
+        async with self.session.get(list_url, headers=self.headers) as resp:
+            resp.raise_for_status()
+            return {terminal["name"] for terminal in await resp.json()}
+
+    @property
+    def closed(self):
+        """
+        True if the websocket to terminado has been closed
+        """
+        return self.ws is not None and self.ws.closed
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
     def send(self, data):
         """
@@ -47,7 +197,7 @@ class Terminado:
 
         data should be a list of strings
         """
-        return self.ws.send(json.dumps(data))
+        return self.ws.send(json_dumps(data))
 
     def send_stdin(self, data):
         """
@@ -55,27 +205,27 @@ class Terminado:
 
         data should be a string
         """
-        return self.send(["stdin", data])
+        return self.ws.send(encode_stdin(data))
 
     def set_size(self, rows, cols):
         """
         Set terminado's terminal cols / rows size
         """
-        return self.send(["set_size", rows, cols])
+        return self.ws.send(encode_set_size(rows, cols))
 
     async def on_receive(self, on_receive):
         """
         Add callback for when data is received from terminado
 
-        on_receive is called for each incoming message. Receives the JSON decoded
-        message as only param.
+        on_receive is called for each incoming message, with the kind of message
+        and its payload as params.
 
         Returns when the connection has been closed
         """
         while True:
             try:
-                data = await self.ws.recv()
-            except websockets.exceptions.ConnectionClosedError:
+                message = await self.ws.recv()
+            except websockets.exceptions.ConnectionClosed:
                 print("websocket done")
                 break
-            await on_receive(json.loads(data))
+            await on_receive(*decode_message(message))
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import random
+import time
+
+
+class Span:
+    """
+    A timed phase of handling a connection
+
+    Spans can be used as context managers, ending when the block exits.
+    """
+
+    __slots__ = (
+        "tracer",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "attributes",
+        "start_ns",
+        "end_ns",
+    )
+
+    def __init__(self, tracer, trace_id, parent_id, name, attributes):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set(self, **attributes):
+        """
+        Add attributes describing the span
+        """
+        self.attributes.update(attributes)
+
+    def end(self, **attributes):
+        """
+        End the span, if it hasn't ended yet, and export it
+        """
+        if self.end_ns is not None:
+            return
+        self.attributes.update(attributes)
+        self.end_ns = time.time_ns()
+        self.tracer.export(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.end_ns is None:
+            self.attributes["error"] = exc_type.__name__
+        self.end()
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_ns / 1e9,
+            "duration": (self.end_ns - self.start_ns) / 1e9,
+            "attributes": self.attributes,
+        }
+
+
+class NullSpan:
+    """
+    A span that records nothing, for when tracing is off
+    """
+
+    __slots__ = ()
+
+    trace_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class NullTracer:
+    """
+    A tracer that records nothing, for when tracing is off
+    """
+
+    def start_span(self, name, parent=None, **attributes):
+        return NULL_SPAN
+
+    async def close(self):
+        pass
+
+
+class Tracer:
+    """
+    Create spans and pass them to exporters as they end
+
+    Spans started without a parent begin a new trace.
+    """
+
+    def __init__(self, exporters):
+        self.exporters = exporters
+
+    def start_span(self, name, parent=None, **attributes):
+        if parent is None:
+            trace_id = f"{random.getrandbits(128):032x}"
+            parent_id = None
+        else:
+            trace_id = parent.trace_id
+            parent_id = parent.span_id
+        return Span(self, trace_id, parent_id, name, attributes)
+
+    def export(self, span):
+        for exporter in self.exporters:
+            exporter.export(span)
+
+    async def close(self):
+        for exporter in self.exporters:
+            await exporter.close()
+
+
+class JSONLinesExporter:
+    """
+    Write spans to a file, one JSON object per line
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def export(self, span):
+        # A single write per line keeps lines from several workers apart
+        self.file.write(json.dumps(span.to_dict()) + "\n")
+        self.file.flush()
+
+    async def close(self):
+        self.file.close()
+
+
+def otlp_attributes(attributes):
+    """
+    Return attributes in OTLP's JSON representation
+    """
+    encoded = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            value = {"boolValue": value}
+        elif isinstance(value, int):
+            value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            value = {"doubleValue": value}
+        else:
+            value = {"stringValue": str(value)}
+        encoded.append({"key": key, "value": value})
+    return encoded
+
+
+class OTLPExporter:
+    """
+    Send spans in batches to an OpenTelemetry collector, with OTLP/HTTP JSON
+
+    Spans are sent every interval seconds, or sooner once batch_size of them
+    are waiting. If the collector can't keep up, spans beyond max_queue are
+    dropped rather than kept around.
+    """
+
+    batch_size = 512
+    max_queue = 8192
+
+    def __init__(self, endpoint, http_client, interval, log):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.http_client = http_client
+        self.interval = interval
+        self.log = log
+
+        self._queue = []
+        self._flush_handle = None
+        self._sending = set()
+
+    def export(self, span):
+        if len(self._queue) >= self.max_queue:
+            return
+        self._queue.append(span)
+        if len(self._queue) >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.interval, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._queue:
+            spans, self._queue = self._queue, []
+            sending = asyncio.ensure_future(self.send(spans))
+            self._sending.add(sending)
+            sending.add_done_callback(self._sending.discard)
+
+    def encode(self, spans):
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": otlp_attributes(
+                            {"service.name": "jupyterhub-ssh"}
+                        )
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "jupyterhub_ssh"},
+                            "spans": [
+                                {
+                                    "traceId": span.trace_id,
+                                    "spanId": span.span_id,
+                                    "parentSpanId": span.parent_id or "",
+                                    "name": span.name,
+                                    # SPAN_KIND_SERVER for whole connections
+                                    "kind": 2 if span.parent_id is None else 1,
+                                    "startTimeUnixNano": str(span.start_ns),
+                                    "endTimeUnixNano": str(span.end_ns),
+                                    "attributes": otlp_attributes(span.attributes),
+                                }
+                                for span in spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    async def send(self, spans):
+        try:
+            async with self.http_client.post(self.url, json=self.encode(spans)) as resp:
+                resp.raise_for_status()
+        except Exception as e:
+            self.log.warning(
+                "Failed to send %i spans to %s: %r", len(spans), self.url, e
+            )
+
+    async def close(self):
+        self.flush()
+        if self._sending:
+            await asyncio.wait(self._sending)
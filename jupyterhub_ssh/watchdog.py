@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from .metrics import EVENT_LOOP_LAG_SECONDS
+
+
+class LoopWatchdog:
+    """
+    Measure event loop lag, and report what blocked the loop when it lags
+
+    Anything blocking the event loop delays every connection served by it.
+    A callback scheduled every interval seconds measures how late the loop
+    runs it, which is recorded as event loop lag.
+
+    If threshold is more than 0, a thread also checks every interval seconds
+    whether that callback is more than threshold seconds late. While it is,
+    the stack of the thread running the loop is sampled, showing what is
+    blocking it. Once the loop catches up, the stall is logged along with
+    the code it was spent in, longest first.
+    """
+
+    # Most distinct stacks logged per stall, and frames shown of each
+    max_stacks = 3
+    max_frames = 8
+
+    def __init__(self, threshold, interval=0.05, log=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.log = log or logging.getLogger(__name__)
+
+        self._loop = None
+        self._loop_thread_id = None
+        self._handle = None
+        # time.monotonic() the next tick is due at
+        self._due = None
+        # Stacks sampled during the current stall, shared with the thread
+        self._samples = Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        """
+        Start watching the running event loop
+        """
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._schedule()
+        if self.threshold > 0:
+            thread = threading.Thread(
+                target=self._watch, name="event-loop-watchdog", daemon=True
+            )
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def _schedule(self):
+        self._due = time.monotonic() + self.interval
+        self._handle = self._loop.call_later(self.interval, self._tick)
+
+    def _tick(self):
+        lag = max(time.monotonic() - self._due, 0)
+        EVENT_LOOP_LAG_SECONDS.observe(lag)
+        with self._lock:
+            samples, self._samples = self._samples, Counter()
+        if self.threshold > 0 and lag > self.threshold:
+            self._report(lag, samples)
+        self._schedule()
+
+    def _report(self, lag, samples):
+        if not samples:
+            self.log.warning("Event loop was blocked for %.3fs", lag)
+            return
+        total = sum(samples.values())
+        lines = [f"Event loop was blocked for {lag:.3f}s, in:"]
+        for stack, count in samples.most_common(self.max_stacks):
+            lines.append(f"~{lag * count / total:.3f}s in")
+            lines.extend(
+                line.rstrip("\n") for line in traceback.format_list(list(stack))
+            )
+        self.log.warning("\n".join(lines))
+
+    def _watch(self):
+        """
+        Sample the loop's stack while it is late, until stopped
+        """
+        while not self._stopped.wait(self.interval):
+            if time.monotonic() - self._due <= self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame, limit=self.max_frames)
+            # FrameSummary isn't hashable, so count stacks by their frames
+            key = tuple(
+                (summary.filename, summary.lineno, summary.name, summary.line)
+                for summary in stack
+            )
+            with self._lock:
+                self._samples[key] += 1
@@ -0,0 +1,158 @@
+import multiprocessing
+import os
+import signal
+import time
+
+STAT_NAMES = (
+    "connections_total",
+    "connections_active",
+    "sessions_total",
+    "sessions_active",
+    "logins_failed",
+)
+# Stats counting things that are currently going on, rather than that have
+# happened so far
+ACTIVE_STAT_NAMES = ("connections_active", "sessions_active")
+
+
+class WorkerStats:
+    """
+    Counters kept by each worker process, readable by the supervisor
+
+    The counters live in shared memory created before workers are forked.
+    Each worker only ever updates its own counters, so no locking is needed.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        # Index of the worker using this process' counters
+        self.worker = 0
+        self._values = multiprocessing.RawArray("q", workers * len(STAT_NAMES))
+
+    def _index(self, worker, name):
+        return worker * len(STAT_NAMES) + STAT_NAMES.index(name)
+
+    def incr(self, name, value=1):
+        self._values[self._index(self.worker, name)] += value
+
+    def decr(self, name, value=1):
+        self.incr(name, -value)
+
+    def reset_active(self, worker):
+        """
+        Zero counters of things going on in a worker that has exited
+        """
+        for name in ACTIVE_STAT_NAMES:
+            self._values[self._index(worker, name)] = 0
+
+    def totals(self):
+        """
+        Return a dict of stats summed over all workers
+        """
+        return {
+            name: sum(
+                self._values[self._index(worker, name)]
+                for worker in range(self.workers)
+            )
+            for name in STAT_NAMES
+        }
+
+
+class Supervisor:
+    """
+    Run worker processes, restarting them if they exit unexpectedly
+
+    Workers are forked from this process and call run_worker, which is
+    expected to serve until the process is told to stop. SIGTERM and SIGINT
+    received by the supervisor are passed on to all workers, after which it
+    waits for them to exit.
+
+    on_worker_exit, if given, is called with the pid of each worker that
+    has exited.
+    """
+
+    # Seconds to wait before restarting a worker that exited shortly after
+    # being started, so a broken setup doesn't make us fork in a busy loop
+    restart_delay = 1
+
+    def __init__(
+        self, workers, run_worker, stats, log, stats_interval, on_worker_exit=None
+    ):
+        self.workers = workers
+        self.run_worker = run_worker
+        self.stats = stats
+        self.log = log
+        self.stats_interval = stats_interval
+        self.on_worker_exit = on_worker_exit
+
+        # Worker index & start time by pid
+        self._children = {}
+        self._stopping = False
+
+    def spawn(self, worker):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            self.stats.worker = worker
+            exit_code = 0
+            try:
+                self.run_worker()
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                self.log.exception("Worker %i failed", worker)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self.log.info("Started worker %i with pid %i", worker, pid)
+        self._children[pid] = (worker, time.monotonic())
+
+    def stop(self, signum, frame):
+        self._stopping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def log_stats(self):
+        totals = self.stats.totals()
+        self.log.info(
+            "Stats for %i workers: %s",
+            self.workers,
+            ", ".join(f"{name}={value}" for name, value in totals.items()),
+        )
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker in range(self.workers):
+            self.spawn(worker)
+
+        next_stats_at = time.monotonic() + self.stats_interval
+        while self._children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.5)
+                if self.stats_interval > 0 and time.monotonic() >= next_stats_at:
+                    self.log_stats()
+                    next_stats_at = time.monotonic() + self.stats_interval
+                continue
+
+            worker, started_at = self._children.pop(pid)
+            self.stats.reset_active(worker)
+            if self.on_worker_exit is not None:
+                self.on_worker_exit(pid)
+            if self._stopping:
+                continue
+            if os.WIFSIGNALED(status):
+                reason = f"was killed by signal {os.WTERMSIG(status)}"
+            else:
+                reason = f"exited with code {os.WEXITSTATUS(status)}"
+            self.log.warning(
+                "Worker %i with pid %i %s, restarting it", worker, pid, reason
+            )
+            if time.monotonic() - started_at < self.restart_delay:
+                time.sleep(self.restart_delay)
+            self.spawn(worker)
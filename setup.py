@@ -25,5 +25,9 @@ setuptools.setup(
         "yarl",
         "websockets",
         "async-timeout",
+        "prometheus_client",
     ],
+    extras_require={
+        "speedups": ["orjson", "uvloop; sys_platform != 'win32'"],
+    },
 )